@@ -1,37 +1,117 @@
-from openpyxl import load_workbook, Workbook
+from openpyxl import Workbook
+import argparse
 import datetime as dt
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from shutil import copyfile
 from csv import reader as csvreader
 from csv import writer as csvwriter
 from os.path import join as pathjoin
+from os import cpu_count
+from os.path import getmtime, isdir, isfile
+from time import perf_counter
 
-from backend import search_part, convert_to_dict
+import backend
+from backend import ConnectionManager, chunked, connections, part_sub_status
 
 
-def get_type_parts(part_type):
+PART_TYPES = ("HDD", "MEM", "CPU")
+REPAIR_LOCS = ("1320", "622", "630", "68", "67",
+               "69", "610", "615", "618", "624")
+BRANDS = ("ACE", "ALI", "ASU", "DEL", "GWY", "HEW", "LNV",
+          "MSS", "RCM", "RZR", "SAC", "SYC", "TSC",)
+PURGE_BATCH_SIZE = 1000
+PARALLEL_BATCH_SIZE = 20000
+HUNT_PROCESSES = min(len(PART_TYPES), cpu_count() or 1)
+
+_part_type_index = None
+
+def get_type_parts(part_type, directory="parts_in_sp"):
     """
     Returns a list of part numbers based on part_type.
 
     :param part_type: String indicating 'HDD', 'MEM', or 'CPU'
+    :param directory: Folder holding the all<part_type>.csv files
     :return: List of part numbers from csv file
     """
-    file = pathjoin("parts_in_sp", "all" + part_type + ".csv")
+    file = pathjoin(directory, "all" + part_type + ".csv")
     data = []
     with open(file, "r") as csvfile:
         reader = csvreader(csvfile)
         for row in reader:
-            data.append(row[0])
+            if row:
+                data.append(row[0])
     return data
 
+class PartTypeIndex:
+    """
+    Maps every part number in the parts_in_sp files to its part type
+    so a lookup is a single dict access instead of a scan of each
+    list.  When a part number is listed for more than one type the
+    first of HDD, MEM, CPU wins, as it did in get_type.
+    """
+
+    def __init__(self, directory="parts_in_sp"):
+        self.directory = directory
+        self.mtimes = self.file_mtimes()
+        self.types = {}
+        self.parts = {}
+        for part_type in PART_TYPES:
+            self.parts[part_type] = set(get_type_parts(part_type, directory))
+            for part_num in self.parts[part_type]:
+                self.types.setdefault(part_num, part_type)
+
+    def file_mtimes(self):
+        """Returns the modification time of each parts_in_sp file."""
+        return tuple(
+            getmtime(pathjoin(self.directory, "all" + part_type + ".csv"))
+            for part_type in PART_TYPES
+        )
+
+    def is_stale(self):
+        """Returns True if any of the files changed since the index was built."""
+        return self.file_mtimes() != self.mtimes
+
+    def get(self, part_num):
+        """
+        Returns the part type of part_num.
+
+        :param part_num: Part number
+        :return: "HDD", "MEM", "CPU" or None
+        """
+        return self.types.get(part_num)
+
+    def __getitem__(self, part_type):
+        return self.parts[part_type]
+
+    def __contains__(self, part_num):
+        return part_num in self.types
+
+    def __len__(self):
+        return len(self.types)
+
+def get_part_type_index(directory="parts_in_sp"):
+    """
+    Returns the cached PartTypeIndex, rebuilding it only when the
+    parts_in_sp files have changed since it was built.
+
+    :param directory: Folder holding the all<part_type>.csv files
+    :return: PartTypeIndex
+    """
+    global _part_type_index
+    if (_part_type_index is None or _part_type_index.directory != directory
+            or _part_type_index.is_stale()):
+        _part_type_index = PartTypeIndex(directory)
+    return _part_type_index
+
 def get_all_parts():
     """
-    Returns a dictionary with part types as keys and a part numbers as values.
+    Returns the PartTypeIndex of all known part numbers.  Indexing it
+    with 'HDD', 'MEM' or 'CPU' gives the set of part numbers of that
+    type.
     """
-    all_parts = {}
-    for part_type in ["HDD", "MEM", "CPU"]:
-        all_parts[part_type] = get_type_parts(part_type)
-        
-    return all_parts
+    return get_part_type_index()
 
 def copy_file(original):
     """
@@ -51,95 +131,273 @@ def get_type(part_num, all_parts):
     returns a sring indicating which is true.
 
     :param part_num: Part number
+    :param all_parts: PartTypeIndex from get_all_parts
     :return: "HDD", "MEM", or "CPU"
     """
+    if isinstance(all_parts, PartTypeIndex):
+        return all_parts.get(part_num)
+
+    for part_type in PART_TYPES:
+        if part_num in all_parts[part_type]:
+            return part_type
+    return None
+
+def read_report(file):
+    """
+    Yields the rows of the tab-delimited openPO report one at a time,
+    skipping the header row.
+
+    :param file: Path of the openPO report
+    """
+    with open(file, "r") as csvfile:
+        reader = csvreader(csvfile, delimiter="\t")
+        next(reader, None)
+        for row in reader:
+            yield row
+
+def validate(row, all_parts):
+    """
+    Checks if an openPO row is an order this hunt cares about.
+
+    :param row: Row from the openPO report
+    :param all_parts: PartTypeIndex from get_all_parts
+    :return: True or False
+    """
+    if len(row) < 32:
+        return False
+    if row[0] not in REPAIR_LOCS:
+        return False
+    if get_type(row[31], all_parts) is None:
+        return False
+    if row[21] not in BRANDS:
+        return False
+    if row[14] is None:
+        return False
+    if row[15] != row[14]:
+        return False
+
+    return True
+
+def filter_data(rows, all_parts):
+    """
+    Yields the part number, type, warranty and order number of each
+    row that passes validate.
+
+    :param rows: Iterable of openPO rows
+    :param all_parts: PartTypeIndex from get_all_parts
+    """
+    for row in rows:
+        if validate(row, all_parts):
+            yield [row[31], get_type(row[31], all_parts), row[14], row[13]]
+
+def _init_purge_worker(database):
+    """Gives a purge worker process its own read-only connection."""
+    backend.connections = ConnectionManager(database, read_only=True)
 
-    if part_num in all_parts["HDD"]:
-        return "HDD"
-    elif part_num in all_parts["MEM"]:
-        return "MEM"
-    elif part_num in all_parts["CPU"]:
-        return "CPU"
+def partitioned_status(batch, executor):
+    """
+    Splits batch by part type and looks up each partition with
+    part_sub_status in its own worker process.
+
+    :param batch: List of part numbers
+    :param executor: ProcessPoolExecutor set up by iter_purged
+    :return: Dictionary in the form part_sub_status returns
+    """
+    partitions = {}
+    for part_num in batch:
+        table = part_num[1].lower()
+        partitions.setdefault(table, set()).add((part_num[0], table))
+    futures = [executor.submit(part_sub_status, list(parts))
+               for parts in partitions.values()]
+    status = {}
+    for future in futures:
+        status.update(future.result())
+    return status
+
+def iter_purged(part_nums, batch_size=PURGE_BATCH_SIZE, processes=0):
+    """
+    Loops through part_nums and yields the part numbers that are
+    not in the database or have no sub.  Part numbers are checked
+    batch_size at a time with part_sub_status, so results come out
+    while part_nums is still being read.  A part missing from the
+    database is only yielded the first time it is seen.
+
+    :param part_nums: Iterable of part numbers to be checked
+    :param batch_size: Part numbers per database lookup
+    :param processes: If more than 1, each batch is split by part
+        type and the partitions are checked in this many worker
+        processes.  Results still come out in the order of part_nums.
+    """
+    if processes > 1:
+        with ProcessPoolExecutor(processes, initializer=_init_purge_worker,
+                                 initargs=(connections.database,)) as executor:
+            for part_num in _purge_batches(part_nums, batch_size, executor):
+                yield part_num
     else:
-        return None
+        for part_num in _purge_batches(part_nums, batch_size, None):
+            yield part_num
 
-def purge_subbed(part_nums):
+def _purge_batches(part_nums, batch_size, executor):
+    """
+    Does the work of iter_purged.  Batches too small to be worth
+    sending to the worker processes are checked in this process, and
+    the executor only starts its workers once a large batch comes in.
+    """
+    missing_seen = set()
+    for batch in chunked(part_nums, batch_size):
+        if executor is None or len(batch) < PURGE_BATCH_SIZE:
+            status = part_sub_status((part_num[0], part_num[1].lower())
+                                     for part_num in batch)
+        else:
+            status = partitioned_status(batch, executor)
+        for part_num in batch:
+            flags = status[(part_num[0], part_num[1].lower())]
+            if flags is None:
+                if tuple(part_num) not in missing_seen:
+                    missing_seen.add(tuple(part_num))
+                    yield part_num
+            elif flags == ("FALSE", "FALSE"):
+                yield part_num
+
+def purge_subbed(part_nums, processes=0):
     """
     Loops through part_nums and checks if the part number is
     in the database and if not, adds it to clean_list. Also
-    calls convert_to_dict to check if part number has a sub.
-    If not, the part is added to the clean_list.
+    checks if the part number has a sub. If not, the part is
+    added to the clean_list.
 
     :param part_nums: List of part numbers to be checked
+    :param processes: Worker processes to split the check across
+        by part type, see iter_purged
     :return: List of parts that are not in the databse or have no
         sub relation setup
     """
-    clean_list = []
-    for part_num in part_nums:
-        if (search_part(part_num[1].lower(), part_num[0]) is None and
-                part_num not in clean_list):
-            clean_list.append(part_num)
-        elif (search_part(part_num[1].lower(), part_num[0]) is not None):
-            part_dict = convert_to_dict(part_num[1].lower(), part_num[0])
-            if (part_dict["subbed"] == "FALSE" and part_dict["do_not_sub"] == "FALSE"):
-                clean_list.append(part_num)
+    batch_size = max(len(part_nums), 1) if processes > 1 else PURGE_BATCH_SIZE
+    return list(iter_purged(part_nums, batch_size, processes))
 
-    return clean_list
+def hunt(file, all_parts=None, processes=HUNT_PROCESSES):
+    """
+    Streams the openPO report through validation, type lookup and
+    the database check.  Nothing is read until the result is
+    iterated, and only one batch of rows is held at a time.
 
-def save_to_file(part_nums):
+    :param file: Path of the openPO report
+    :param all_parts: PartTypeIndex, defaults to get_all_parts()
+    :param processes: Worker processes for the database check, one
+        per part type by default (capped at the number of CPUs).  0 or
+        1 checks every part in this process.
+    :return: Generator of parts that need a sub
     """
-    Creates a workbook object and builds the 'Needs Sub' and
-    'Non-Warr Orders' sheets then saves the workbook as an
-    Excel file.
+    if all_parts is None:
+        all_parts = get_all_parts()
+    batch_size = PARALLEL_BATCH_SIZE if processes > 1 else PURGE_BATCH_SIZE
+    return iter_purged(filter_data(read_report(file), all_parts),
+                       batch_size, processes)
 
-    :param part_nums: List of part numbers to be saved
-    :return: 'Done'
+def hunt_path(directory="hunts"):
     """
+    Returns the path today's hunt is saved to.
 
-    def build_sheets():
-        """
-        Populates the sheets with values based on the data provided
-        in the part_nums list.
-        """
-        parts_seen = []
-        add_to_sheet2 = []
-        # Populating cell data for 'Needs Sub' sheet
-        headings = ["Part Num", "Type"]
-        for heading in enumerate(headings):
-            worksheet1.cell(row=1, column=heading[0] + 1,
-                            value=heading[1])
-        row_num = 2
-        for row in part_nums:
-            if row[2] != "MFG Warranty":
-                add_to_sheet2.append(row)
-            if row[0] not in parts_seen:
-                for part_data in enumerate(row[:2]):
-                    worksheet1.cell(row=row_num, column=part_data[0] + 1,
-                                    value=part_data[1])
-                parts_seen.append(row[0])
-                row_num += 1
-            else:
-                continue
-        # Populating cell data for 'Non-Warr Orders' sheet
-        if len(add_to_sheet2):
-            headings = ["Part Num", "Type", "Warr", "SO"]
-            for heading in enumerate(headings):
-                worksheet2.cell(row=1, column=heading[0] + 1,
-                                value=heading[1])
-            for row in enumerate(add_to_sheet2):
-                for element in enumerate(row[1]):
-                    worksheet2.cell(row=row[0] + 2, column=element[0] + 1,
-                                    value=element[1])
-
-    path = pathjoin(
-        r"hunts",
-        str(dt.date.today()) + " hunt.xlsx"
-        )
-    workbook = Workbook()
-    worksheet1 = workbook.active
-    worksheet1.title = "Needs Sub"
+    :param directory: Folder the hunt is saved in
+    :return: Path of the Excel file
+    """
+    return pathjoin(directory, str(dt.date.today()) + " hunt.xlsx")
+
+def save_to_file(part_nums, directory="hunts"):
+    """
+    Creates a write-only workbook and streams the 'Needs Sub' and
+    'Non-Warr Orders' sheets in a single pass over part_nums, then
+    saves the workbook as an Excel file.  Rows are written straight
+    out instead of being kept in memory as cells.
+
+    :param part_nums: Iterable of part numbers to be saved
+    :param directory: Folder to save the Excel file in
+    :return: 'Done'
+    """
+    path = hunt_path(directory)
+    workbook = Workbook(write_only=True)
+    worksheet1 = workbook.create_sheet("Needs Sub")
     worksheet2 = workbook.create_sheet("Non-Warr Orders")
-    build_sheets()
+
+    worksheet1.append(["Part Num", "Type"])
+    parts_seen = set()
+    sheet2_started = False
+    for row in part_nums:
+        if row[2] != "MFG Warranty":
+            if not sheet2_started:
+                worksheet2.append(["Part Num", "Type", "Warr", "SO"])
+                sheet2_started = True
+            worksheet2.append(list(row))
+        if row[0] not in parts_seen:
+            worksheet1.append(list(row[:2]))
+            parts_seen.add(row[0])
 
     workbook.save(path)
     return "Done"
+
+def main(argv=None):
+    """
+    Runs the auto hunt from the command line without the GUI, e.g.
+
+        python -m auto_hunt --report openPO.txt --out hunts
+
+    :param argv: Command line arguments, defaults to sys.argv
+    :return: Exit status, 0 on success and 1 on failure
+    """
+    parser = argparse.ArgumentParser(
+        prog="auto_hunt",
+        description="Find parts on order that need a sub and save them to Excel.",
+    )
+    parser.add_argument("--report", required=True,
+                        help="tab-delimited openPO report")
+    parser.add_argument("--out", default="hunts",
+                        help="folder to save the hunt in (default: hunts)")
+    parser.add_argument("--parts", default="parts_in_sp",
+                        help="folder holding allHDD/allMEM/allCPU.csv "
+                             "(default: parts_in_sp)")
+    parser.add_argument("--db", default=None,
+                        help="SQLite database to check against")
+    parser.add_argument("--processes", type=int, default=HUNT_PROCESSES,
+                        help="worker processes for the database check, "
+                             "0 to check in this process (default: %(default)s)")
+    parser.add_argument("--copy", action="store_true",
+                        help="keep a copy of the report in 'openPO Reports'")
+    args = parser.parse_args(argv)
+
+    database = args.db or connections.database
+    if not isfile(database):
+        print("Error! No database at " + database, file=sys.stderr)
+        return 1
+    if not isdir(args.out):
+        print("Error! No folder at " + args.out, file=sys.stderr)
+        return 1
+    connections.database = database
+
+    start = perf_counter()
+    counted = [0]
+
+    def count(part_nums):
+        for part_num in part_nums:
+            counted[0] += 1
+            yield part_num
+
+    try:
+        # Open the report before any workbook is made, so a missing or
+        # unreadable report fails here rather than part way through
+        # save_to_file.
+        with open(args.report, "r"):
+            pass
+        if args.copy:
+            copy_file(args.report)
+        all_parts = get_part_type_index(args.parts)
+        save_to_file(count(hunt(args.report, all_parts, args.processes)), args.out)
+    except (OSError, sqlite3.Error) as e:
+        print("Error! " + repr(e), file=sys.stderr)
+        return 1
+
+    print("{} parts need a sub, saved to {} in {:.2f}s".format(
+        counted[0], hunt_path(args.out), perf_counter() - start))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
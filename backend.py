@@ -1,54 +1,372 @@
 """Handles the sqlite3 database."""
+import re
 import sqlite3
-from csv import DictReader as csv_DictReader
+import threading
+from contextlib import contextmanager
 from csv import writer as csvwriter
 from csv import reader as csvreader
 from collections import OrderedDict
-from os.path import basename
+from functools import partial
+from glob import glob
+from multiprocessing import Pool, Queue, cpu_count
+from os.path import abspath, basename
+from os.path import join as pathjoin
+from queue import Empty
+from time import perf_counter
+from urllib.request import pathname2url
+
+
+DATABASE = r"db\parts.db"
+IMPORT_CHUNK_SIZE = 5000
+PAGE_SIZE = 200
+ANALYSIS_LIMIT = 1000
+RECORD_CACHE_SIZE = 2048
+SEARCH_LIMIT = 50
+SUGGEST_LIMIT = 10
+TRIGRAM_LENGTH = 64
+CANDIDATE_LIMIT = 500
+
+# Applied to every connection.  WAL lets the GUI keep reading while an
+# import or a hunt writes; the WAL is checkpointed automatically every
+# 1000 pages and cut back to journal_size_limit bytes afterwards.
+# recursive_triggers makes REPLACE fire the delete triggers that keep
+# sub_groups current for the row it replaces.
+JOURNAL_MODE = "PRAGMA journal_mode = WAL"
+PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA wal_autocheckpoint = 1000",
+    "PRAGMA journal_size_limit = 16777216",
+    "PRAGMA recursive_triggers = ON",
+)
+
+
+class ConnectionManager:
+    """
+    Keeps one connection to the SQLite3 database per thread and reuses
+    it across calls.  Connections are opened in autocommit mode, so any
+    statements that need to be applied together should be run inside
+    transaction().  The first connection opened also upgrades the
+    database schema, unless the manager is read-only.
+    """
+
+    def __init__(self, database, read_only=False):
+        self.database = database
+        self.read_only = read_only
+        self.upgraded = read_only
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """
+        Return the connection for the calling thread, opening it on
+        first use.
+
+        :return: Connection object or None
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            try:
+                if self.read_only:
+                    uri = "file:" + pathname2url(abspath(self.database)) + "?mode=ro"
+                    conn = sqlite3.connect(uri, uri=True, isolation_level=None)
+                else:
+                    conn = sqlite3.connect(self.database, isolation_level=None)
+                    conn.execute(JOURNAL_MODE)
+                for pragma in PRAGMAS:
+                    conn.execute(pragma)
+            except Exception as e:
+                print(repr(e))
+                return None
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                if not self.upgraded:
+                    self.upgraded = True
+                    upgrade_schema()
+        return conn
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        """
+        Run the enclosed block inside a single transaction on the
+        calling thread's connection.  Nested scopes join the outermost
+        one, which commits on success and rolls back on error.
+
+        :param immediate: Take the write lock up front so the busy
+            timeout applies, rather than failing when a read turns into
+            a write.  Pass False for blocks that only read or only touch
+            temporary tables.
+        :return: Connection object
+        """
+        conn = self.connection()
+        if conn is None:
+            raise sqlite3.OperationalError("Unable to connect to the database.")
+        outermost = self._local.depth == 0
+        if outermost:
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self._local.depth += 1
+        try:
+            yield conn
+            if outermost:
+                conn.execute("COMMIT")
+        except BaseException:
+            if outermost and conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth -= 1
+
+    def checkpoint(self, mode="PASSIVE"):
+        """
+        Copy the WAL back into the database file.  PASSIVE never waits;
+        TRUNCATE waits for readers to finish and then empties the WAL
+        file, which is done after bulk writes.
+
+        :param mode: PASSIVE, FULL, RESTART or TRUNCATE
+        :return: Tuple of busy, WAL pages and pages checkpointed
+        """
+        conn = self.connection()
+        try:
+            return conn.execute("PRAGMA wal_checkpoint(" + mode + ")").fetchone()
+        except sqlite3.Error as e:
+            print(repr(e))
+
+    def close(self):
+        """
+        Close the calling thread's connection if one is open, first
+        letting SQLite refresh any planner statistics that have gone
+        stale.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            try:
+                if not self.read_only:
+                    conn.execute("PRAGMA optimize")
+                conn.close()
+            except Exception as e:
+                print(repr(e))
+
+
+connections = ConnectionManager(DATABASE)
 
 
 def create_connection():
     """
-    Create a database connection to the SQLite3 database.
+    Return the calling thread's connection to the SQLite3 database.
 
     :return: Connection object or None
     """
-    try:
-        conn = sqlite3.connect(r"db\parts.db")
-        return conn
-    except Exception as e:
-        print(repr(e))
-
-    return None
+    return connections.connection()
 
 
 def close_connection(conn):
     """
-    Close database connection to the SQLite3 database.
+    Kept for callers written against the old one-connection-per-call
+    API.  The shared connection stays open for reuse, and writes are
+    committed by transaction() or by autocommit.
 
     :param conn: Connection object
     """
+
+
+SCHEMA_VERSION = 1
+
+SCHEMAS = {
+    "hdd": [
+        "part_num",
+        "brand",
+        "connector",
+        "hdd_capacity",
+        "ssd_capacity",
+        "speed",
+        "type",
+        "physical_size",
+        "height",
+        "interface",
+        "description",
+        "do_not_sub",
+        "subbed",
+    ],
+    "mem": [
+        "part_num",
+        "speed",
+        "brand",
+        "connector",
+        "capacity",
+        "description",
+        "do_not_sub",
+        "subbed",
+    ],
+    "cpu": [
+        "part_num",
+        "brand",
+        "description",
+        "oem_part_num",
+        "do_not_sub",
+        "subbed",
+    ],
+}
+
+# Secondary indexes for each part table.  The "sub" indexes follow the
+# columns list_subs compares; the rest cover the filters most used on
+# the browse page.
+INDEXES = {
+    "hdd": {
+        "sub": ("connector", "type", "physical_size", "hdd_capacity",
+                "ssd_capacity", "speed"),
+        "type": ("type", "physical_size"),
+        "brand": ("brand",),
+        "subbed": ("subbed", "do_not_sub"),
+    },
+    "mem": {
+        "sub": ("connector", "capacity", "speed"),
+        "brand": ("brand",),
+        "subbed": ("subbed", "do_not_sub"),
+    },
+    "cpu": {
+        "sub": ("oem_part_num",),
+        "brand": ("brand",),
+        "subbed": ("subbed", "do_not_sub"),
+    },
+}
+
+
+def part_kind(table):
+    """
+    Returns which kind of part a table holds based on its name.
+
+    :param table: Name of database table
+    :return: "hdd", "mem", "cpu" or None
+    """
+    for kind in SCHEMAS:
+        if table.lower().startswith(kind):
+            return kind
+    return None
+
+
+def part_tables():
+    """
+    Returns the names of all part tables in the database.
+
+    :return: List of table names
+    """
+    conn = connections.connection()
+    sql = "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"
+    return [row[0] for row in conn.execute(sql) if part_kind(row[0])]
+
+
+def create_part_table(table, headers=None):
+    """
+    Creates a part table with typed columns and its secondary indexes
+    if it does not exist yet.
+
+    :param table: Name of database table
+    :param headers: Column names, defaults to the schema for the
+        table's part type.  The first column is the primary key.
+    """
+    table = table.lower()
+    if headers is None:
+        headers = SCHEMAS[part_kind(table)]
+    columns = ["part_num TEXT PRIMARY KEY"] + [header + " TEXT" for header in headers[1:]]
+    with connections.transaction():
+        create_table(
+            "CREATE TABLE IF NOT EXISTS " + table + "(" + ",".join(columns) + ");"
+        )
+        table_schemas.forget(table)
+        ensure_part_table(table)
+
+
+def ensure_part_table(table, rebuild=True):
+    """
+    Creates any secondary indexes, sub groups and search index entries
+    that table is missing.  Safe to call on a table that is already up
+    to date.
+
+    :param table: Name of database table
+    :param rebuild: Passed on to ensure_sub_groups and
+        ensure_search_index
+    """
+    conn = connections.connection()
+    kind = part_kind(table)
+    if kind is None:
+        return
+    existing = set(table_schemas.columns(table))
+    with connections.transaction():
+        for suffix, columns in INDEXES[kind].items():
+            if existing.issuperset(columns):
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS "
+                    + table
+                    + "_"
+                    + suffix
+                    + " ON "
+                    + table
+                    + " ("
+                    + ", ".join(columns)
+                    + ")"
+                )
+        ensure_sub_groups(table, rebuild)
+        ensure_search_index(table, rebuild)
+    table_schemas.forget(table)
+
+
+def upgrade_schema():
+    """
+    Brings a database created by an older version up to date by
+    adding the indexes, sub groups and search index to every part
+    table.  Runs when the first connection is opened.  Once the
+    database's user_version matches SCHEMA_VERSION it only puts back
+    any triggers that are missing, see restore_part_triggers.
+    """
+    conn = connections.connection()
     try:
-        conn.commit()
-        conn.close()
-    except Exception as e:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            restore_part_triggers()
+            return
+        with connections.transaction():
+            for table in part_tables():
+                ensure_part_table(table)
+            conn.execute("PRAGMA user_version = " + str(SCHEMA_VERSION))
+    except sqlite3.Error as e:
         print(repr(e))
 
 
+def restore_part_triggers():
+    """
+    Rebuilds the sub groups and search index of every part table that
+    is missing its triggers, which is left that way when an
+    import_directory run is killed before it restores them.  Rows may
+    have been changed in any way meanwhile, so the table is rebuilt
+    from scratch rather than caught up.
+    """
+    conn = connections.connection()
+    sql = "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+    triggers = set(row[0] for row in conn.execute(sql))
+    for table in part_tables():
+        wanted = set()
+        if "part_num" in table_schemas.columns(table):
+            wanted.add(table + "_docs_insert")
+        if has_sub_columns(table):
+            wanted.add(table + "_sub_insert")
+        if not triggers.issuperset(wanted):
+            with connections.transaction():
+                drop_part_triggers(table)
+                ensure_part_table(table)
+
+
 def create_table(create_table_sql):
     """
     Create a table from the create_table_sql statement.
 
-    :param conn: Connection object
     :param create_table_sql: a CREATE TABLE statement
     :return:
     """
-    conn = create_connection()
+    conn = connections.connection()
     if conn is not None:
         try:
-            cur = conn.cursor()
-            cur.execute(create_table_sql)
-            close_connection(conn)
+            conn.execute(create_table_sql)
             return True
         except Exception as e:
             print(e)
@@ -62,13 +380,19 @@ def remove_table(table):
 
     :param table:  Table to be removed
     """
-    conn = create_connection()
+    conn = connections.connection()
+    table = table.lower()
 
     try:
         if conn is not None:
-            cur = conn.cursor()
-            cur.execute("DROP TABLE IF EXISTS " + table)
-            close_connection(conn)
+            with connections.transaction():
+                conn.execute("DROP TABLE IF EXISTS " + table)
+                if table_exists("sub_groups"):
+                    conn.execute("DELETE FROM sub_group_members WHERE tbl = ?", (table,))
+                    conn.execute("DELETE FROM sub_groups WHERE tbl = ?", (table,))
+                drop_search_rows(table)
+            table_schemas.forget(table)
+            table_changed(table)
             return True
         else:
             raise sqlite3.OperationalError
@@ -82,15 +406,263 @@ def return_table(table):
 
     :param table:  Table to be returned
     """
-    conn = create_connection()
+    conn = connections.connection()
 
     cur = conn.cursor()
     sql = "SELECT * FROM " + table
     cur.execute(sql)
-    results = cur.fetchall()
-    close_connection(conn)
+    return cur.fetchall()
 
-    return results
+
+def where_clause(my_dict):
+    """
+    Builds a WHERE clause matching every column in my_dict to its
+    value, with the values passed as parameters.
+
+    :param my_dict: Dictionary of columns and desired values
+    :return: Tuple of the clause (empty if my_dict is empty) and the
+        list of values
+    """
+    if not my_dict:
+        return "", []
+    columns = sorted(my_dict)
+    return (
+        " WHERE " + " AND ".join(column + " = ?" for column in columns),
+        [my_dict[column] for column in columns],
+    )
+
+
+_index_cache = {}
+
+
+def table_indexes(table):
+    """
+    Returns the indexes on table along with their planner statistics,
+    read once and cached under the lowercased table name until the
+    table's indexes change or it is analyzed again.
+
+    :param table: Name of database table
+    :return: Dictionary of index name to a tuple of its columns and
+        its sqlite_stat1 row counts (None if not analyzed, except that
+        a unique index is known to return one row for a full match)
+    """
+    table = table.lower()
+    indexes = _index_cache.get(table)
+    if indexes is None:
+        conn = connections.connection()
+        stats = {}
+        if table_exists("sqlite_stat1"):
+            for index, stat in conn.execute(
+                "SELECT idx, stat FROM sqlite_stat1 WHERE tbl = ?", (table,)
+            ):
+                if index:
+                    stats[index] = [int(n) for n in stat.split() if n.isdigit()]
+        indexes = {}
+        for row in conn.execute("PRAGMA index_list(" + table + ")"):
+            columns = [info[2] for info in conn.execute("PRAGMA index_info(" + row[1] + ")")]
+            stat = stats.get(row[1])
+            if stat is None and row[2]:
+                stat = [None] * len(columns) + [1]
+            indexes[row[1]] = (columns, stat)
+        _index_cache[table] = indexes
+    return indexes
+
+
+def forget_indexes(table):
+    """
+    Drops the cached indexes of table so they are read again on next
+    use.  Must be called whenever indexes on table are created or
+    dropped, the table itself is, or it is analyzed.
+
+    :param table: Name of database table
+    """
+    _index_cache.pop(table.lower(), None)
+
+
+def choose_index(table, columns):
+    """
+    Picks the index to search when filtering table on columns.  Only
+    indexes whose leading columns are all being filtered on can be
+    searched; of those, the one sqlite_stat1 expects to return the
+    fewest rows wins, and without statistics the one matching the
+    most columns does.
+
+    :param table: Name of database table
+    :param columns: Columns being filtered on
+    :return: Index name or None if no index can be searched
+    """
+    best = None
+    for index, (index_columns, stat) in table_indexes(table).items():
+        prefix = 0
+        while prefix < len(index_columns) and index_columns[prefix] in columns:
+            prefix += 1
+        if not prefix:
+            continue
+        rows = stat[prefix] if stat and len(stat) > prefix else None
+        key = (rows is None, rows or 0, -prefix)
+        if best is None or key < best[0]:
+            best = (key, index)
+    return best[1] if best else None
+
+
+def filter_source(table, my_dict):
+    """
+    Returns table for use in a FROM clause, with an INDEXED BY hint
+    for the index choose_index picks for the columns in my_dict.
+
+    :param table: Name of database table
+    :param my_dict: Dictionary of columns and desired values
+    """
+    index = choose_index(table, my_dict) if my_dict else None
+    return table + " INDEXED BY " + index if index else table
+
+
+def analyze_tables(tables=None):
+    """
+    Refreshes the planner statistics for tables.  The analysis is
+    limited to ANALYSIS_LIMIT rows per index so it stays quick on
+    large tables.
+
+    :param tables: Names of tables to analyze, defaults to every part
+        table
+    """
+    conn = connections.connection()
+    if tables is None:
+        tables = part_tables()
+    try:
+        conn.execute("PRAGMA analysis_limit = " + str(ANALYSIS_LIMIT))
+        for table in tables:
+            conn.execute("ANALYZE " + table)
+            forget_indexes(table)
+    except sqlite3.Error as e:
+        print(repr(e))
+
+
+def count_rows(table, my_dict=None):
+    """
+    Counts the rows in table, or the rows matching my_dict.
+
+    :param table:  Table to count
+    :param my_dict: Optional dictionary of columns and desired values
+    :return: Number of rows
+    """
+    conn = connections.connection()
+    where, values = where_clause(my_dict)
+    sql = "SELECT count(*) FROM " + filter_source(table, my_dict) + where
+    return conn.execute(sql, values).fetchone()[0]
+
+
+def return_page(table, after=None, limit=PAGE_SIZE, my_dict=None):
+    """
+    Returns one page of table ordered by part_num.  The next page
+    starts after the last part_num of this one, so every page is an
+    index range scan however deep into the table it is.
+
+    :param table:  Table to page through
+    :param after: Last part_num of the previous page, None for the
+        first page
+    :param limit: Rows per page
+    :param my_dict: Optional dictionary of columns and desired values
+    :return: List of rows
+    """
+    conn = connections.connection()
+    where, values = where_clause(my_dict)
+    if after is not None:
+        where += (" AND" if where else " WHERE") + " part_num > ?"
+        values.append(after)
+    sql = (
+        "SELECT * FROM " + filter_source(table, my_dict) + where
+        + " ORDER BY part_num LIMIT ?"
+    )
+    return conn.execute(sql, values + [limit]).fetchall()
+
+
+def iter_pages(table, limit=PAGE_SIZE, my_dict=None):
+    """
+    Yields every row of table, or every row matching my_dict, one
+    page at a time.
+
+    :param table:  Table to read
+    :param limit: Rows per page
+    :param my_dict: Optional dictionary of columns and desired values
+    """
+    after = None
+    while True:
+        page = return_page(table, after, limit, my_dict)
+        for row in page:
+            yield row
+        if len(page) < limit:
+            break
+        after = page[-1][0]
+
+
+class SchemaRegistry:
+    """
+    Column names of each table, read once with PRAGMA table_info and
+    kept until the table is created, dropped or altered, when forget()
+    must be called for it.  Table names are lowercased, as SQLite
+    matches them regardless of case.
+    """
+
+    def __init__(self):
+        self._columns = {}
+        self._placeholders = {}
+        self._lock = threading.Lock()
+
+    def has_table(self, table):
+        """
+        :param table: Name of database table
+        :return: True if table exists
+        """
+        try:
+            self.columns(table)
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    def columns(self, table):
+        """
+        Return the column names of table in order.  The list is shared,
+        so callers must not change it.
+
+        :param table: Name of database table
+        :return: List of column names
+        """
+        table = table.lower()
+        columns = self._columns.get(table)
+        if columns is None:
+            conn = connections.connection()
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(" + table + ")")]
+            if not columns:
+                raise sqlite3.OperationalError("no such table: " + table)
+            with self._lock:
+                self._columns[table] = columns
+                self._placeholders[table] = ",".join("?" for column in columns)
+        return columns
+
+    def placeholders(self, table):
+        """
+        :param table: Name of database table
+        :return: One "?" per column of table joined with commas
+        """
+        self.columns(table)
+        return self._placeholders[table.lower()]
+
+    def forget(self, table):
+        """
+        Drop what is known about table, and its cached indexes, so it
+        is read again on next use.
+
+        :param table: Name of database table
+        """
+        table = table.lower()
+        with self._lock:
+            self._columns.pop(table, None)
+            self._placeholders.pop(table, None)
+        forget_indexes(table)
+
+
+table_schemas = SchemaRegistry()
 
 
 def return_column_names(table):
@@ -99,14 +671,215 @@ def return_column_names(table):
 
     :param table:  Table to pull column names from
     """
-    conn = create_connection()
+    return list(table_schemas.columns(table))
 
-    cur = conn.cursor()
-    sql = "SELECT * FROM " + table
-    cur.execute(sql)
-    names = [description[0] for description in cur.description]
-    close_connection(conn)
-    return names
+
+# Columns with about one value per part.  A filter dropdown for them
+# would list every row, so they are left out of the facets.
+UNFACETED_COLUMNS = ("part_num", "description", "oem_part_num")
+
+
+def facet_columns(table):
+    """
+    Return the columns of table worth filtering on from a dropdown
+
+    :param table:  Table to pull column names from
+    """
+    return [
+        column for column in table_schemas.columns(table)
+        if column not in UNFACETED_COLUMNS
+    ]
+
+
+class RecordCache:
+    """
+    Bounded least recently used cache of part records keyed by table
+    and part number.  Table names are lowercased, as SQLite matches
+    them regardless of case.  Parts that are not in the database are
+    cached too, as None.  Counts hits and misses so the size can be
+    tuned.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, table, part_num):
+        """
+        Return the cached record for part_num.
+
+        :param table: Name of database table
+        :param part_num: Part number
+        :return: Tuple of whether it was cached and the record
+        """
+        key = (table.lower(), part_num)
+        with self._lock:
+            if key in self._records:
+                self._records.move_to_end(key)
+                self.hits += 1
+                return True, self._records[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, table, part_num, record, generation):
+        """
+        Cache record for part_num, evicting the least recently used
+        record when full.  Skipped if anything was invalidated since
+        generation was read, as record may already be stale.
+
+        :param table: Name of database table
+        :param part_num: Part number
+        :param record: Row from the database or None
+        :param generation: Value of generation before record was read
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            key = (table.lower(), part_num)
+            self._records[key] = record
+            self._records.move_to_end(key)
+            while len(self._records) > self.size:
+                self._records.popitem(last=False)
+
+    def invalidate(self, table, part_num=None):
+        """
+        Drop the cached record for part_num, or every record from
+        table if part_num is None.
+
+        :param table: Name of database table
+        :param part_num: Part number
+        """
+        table = table.lower()
+        with self._lock:
+            self.generation += 1
+            if part_num is not None:
+                self._records.pop((table, part_num), None)
+            else:
+                for key in [key for key in self._records if key[0] == table]:
+                    del self._records[key]
+
+    def clear(self):
+        """Drop every cached record and reset the counters."""
+        with self._lock:
+            self.generation += 1
+            self._records.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: Dictionary of hits, misses, records held and size
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "records": len(self._records),
+                "size": self.size,
+            }
+
+
+record_cache = RecordCache(RECORD_CACHE_SIZE)
+_facet_cache = {}
+_facet_lock = threading.Lock()
+
+
+def table_changed(table, part_num=None):
+    """
+    Drops what is cached for table.  Called after any write to it
+    has been committed.
+
+    :param table: Name of the table that changed
+    :param part_num: The only part that changed, or None if any
+        number of parts did
+    """
+    table = table.lower()
+    record_cache.invalidate(table, part_num)
+    with _facet_lock:
+        _facet_cache.pop(table, None)
+
+
+def return_facets(table, columns=None):
+    """
+    Returns the distinct non-empty values of several columns of table
+    at once, taken from the cached counts of facet_counts.
+
+    :param table:  Table to read
+    :param columns:  Columns wanted, defaults to facet_columns
+    :return: Dictionary of column to sorted list of values
+    """
+    counts = facet_counts(table, None, columns)
+    return {column: list(values) for column, values in counts.items()}
+
+
+def facet_counts(table, my_dict=None, columns=None):
+    """
+    Counts, in one grouped query, how many rows each value of each
+    column would match given the filters in my_dict.  A column's own
+    filter is left out of its counts so the other choices for that
+    column still show how many rows they would return.  The counts
+    with no filters are what a table opens with, so those are kept
+    under the lowercased table name until the table changes.
+
+    :param table:  Table to read
+    :param my_dict: Dictionary of columns and desired values
+    :param columns:  Columns wanted, defaults to facet_columns
+    :return: Dictionary of column to OrderedDict of value to count,
+        values sorted and without any that match no rows.  Cached
+        counts are shared, so callers must not change them.
+    """
+    table = table.lower()
+    if columns is None:
+        columns = facet_columns(table)
+    if my_dict:
+        return count_facets(table, my_dict, columns)
+
+    with _facet_lock:
+        cached = dict(_facet_cache.get(table, {}))
+    missing = [column for column in columns if column not in cached]
+    if missing:
+        found = count_facets(table, {}, missing)
+        cached.update(found)
+        with _facet_lock:
+            _facet_cache.setdefault(table, {}).update(found)
+    return {column: cached[column] for column in columns}
+
+
+def count_facets(table, my_dict, columns):
+    """
+    Runs the grouped query behind facet_counts.  Each column is
+    counted with its own SELECT, joined with UNION ALL.
+
+    :param table:  Table to read
+    :param my_dict: Dictionary of columns and desired values
+    :param columns:  Columns to count
+    :return: Dictionary in the form facet_counts returns
+    """
+    if not columns:
+        return {}
+
+    selects = []
+    values = []
+    for i, column in enumerate(columns):
+        where, where_values = where_clause(
+            {k: v for k, v in my_dict.items() if k != column}
+        )
+        where += (" AND " if where else " WHERE ") + column + " != ''"
+        selects.append(
+            "SELECT " + str(i) + ", " + column + ", count(*) FROM " + table
+            + where + " GROUP BY " + column
+        )
+        values.extend(where_values)
+
+    found = {column: [] for column in columns}
+    conn = connections.connection()
+    for i, value, count in conn.execute(" UNION ALL ".join(selects), values):
+        found[columns[i]].append((value, count))
+    return {column: OrderedDict(sorted(found[column])) for column in columns}
 
 
 def return_possible_values(table, column):
@@ -117,58 +890,45 @@ def return_possible_values(table, column):
     :param column:  Column with the values we want
     :return result:  List of values in column
     """
-    conn = create_connection()
-
-    cur = conn.cursor()
-    values = [value[0] for value in cur.execute("SELECT " + column + " FROM " + table)]
-    close_connection(conn)
-    result = []
-    for value in values:
-        if value not in result and value != "":
-            result.append(value)
-
-    return sorted(result)
+    return return_facets(table, [column])[column]
 
 
 def part_in_db(table, part_num):
     """
     Checks to see if part exists in the database.
 
-    :param conn: Connection object
     :param table: Name of database table
     :param part: Part number to check
     :return: True or False
     """
-    conn = create_connection()
-    cur = conn.cursor()
-    sql = "SELECT count(*) FROM " + table + " WHERE part_num = ?"
-    cur.execute(sql, (part_num,))
-    result = cur.fetchone()[0]
-    close_connection(conn)
-    return result
+    return search_part(table, part_num) is not None
 
 
 def search_part(table, part):
     """
-    Returns part info if part is in database.
+    Returns part info if part is in database.  The row is read with
+    a single primary key lookup and can be indexed by position or by
+    column name.
 
-    :param conn: Connection object
     :param table: Name of database table
     :param part: Part number
-    :return: Part info or None
+    :return: sqlite3.Row of part info or None
     """
-    conn = create_connection()
+    table = table.lower()
+    cached, record = record_cache.get(table, part)
+    if cached:
+        return record
+
+    conn = connections.connection()
 
     if conn is not None:
+        generation = record_cache.generation
         cur = conn.cursor()
-
-        if part_in_db(table, part):
-            cur.execute("SELECT * FROM " + table + " WHERE part_num = ?", (part,))
-            result = cur.fetchone()
-            close_connection(conn)
-            return result
-        else:
-            return None
+        cur.row_factory = sqlite3.Row
+        cur.execute("SELECT * FROM " + table + " WHERE part_num = ?", (part,))
+        record = cur.fetchone()
+        record_cache.put(table, part, record, generation)
+        return record
     else:
         print("Error! Unable to connect to the database.")
 
@@ -180,18 +940,12 @@ def filter_columns(table, my_dict):
     :param table:  Table we're filtering
     :param my_dcit: Dictionary of columns and desired values
     """
-    conn = create_connection()
-    sql_fragments = []
-    for k, v in my_dict.items():
-        sql_fragments.append(k + " = '" + v + "'")
-
+    conn = connections.connection()
     if conn is not None:
-        cur = conn.cursor()
-        sql = "SELECT * FROM " + table.lower() + " WHERE " + " AND ".join(sql_fragments)
-        cur.execute(sql)
-        result = cur.fetchall()
-        close_connection(conn)
-        return result
+        table = table.lower()
+        where, values = where_clause(my_dict)
+        sql = "SELECT * FROM " + filter_source(table, my_dict) + where
+        return conn.execute(sql, values).fetchall()
 
 
 def add_part(table, part_info):
@@ -202,53 +956,17 @@ def add_part(table, part_info):
     :param part: part_info to add
     :return: "Done"
     """
-    conn = create_connection()
+    conn = connections.connection()
     if conn is not None:
-        cur = conn.cursor()
-        if table.startswith("hdd"):
-            headers = [
-                "part_num PRIMARY KEY",
-                "brand",
-                "connector",
-                "hdd_capacity",
-                "ssd_capacity",
-                "speed",
-                "type",
-                "physical_size",
-                "height",
-                "interface",
-                "description",
-                "do_not_sub",
-                "subbed",
-            ]
-        if table.startswith("mem"):
-            headers = [
-                "part_num PRIMARY KEY",
-                "speed",
-                "brand",
-                "connector",
-                "capacity",
-                "description",
-                "do_not_sub",
-                "subbed",
-            ]
-        if table.startswith("cpu"):
-            headers = [
-                "part_num PRIMARY KEY",
-                "brand",
-                "description",
-                "oem_part_num",
-                "do_not_sub",
-                "subbed",
-            ]
-        create_table(
-            "CREATE TABLE IF NOT EXISTS " + table + "(" + ",".join(headers) + ");"
-        )
-        cur.execute("SELECT * FROM " + table + ";")
-        columns = ["?" for list in cur.description]
-        sql = "INSERT OR IGNORE INTO " + table + " VALUES (" + ",".join(columns) + ");"
-        cur.execute(sql, part_info)
-        close_connection(conn)
+        with connections.transaction():
+            if not table_schemas.has_table(table):
+                create_part_table(table)
+            sql = (
+                "INSERT OR IGNORE INTO " + table
+                + " VALUES (" + table_schemas.placeholders(table) + ");"
+            )
+            conn.execute(sql, part_info)
+        table_changed(table, part_info[0])
         return "Done"
     else:
         print("Error! Unable to connect to the database.")
@@ -262,14 +980,13 @@ def remove_part(table, part_num):
     :param part: Part to remove
     :return: "Done" or None
     """
-    conn = create_connection()
+    conn = connections.connection()
     if conn is not None:
         if part_in_db(table, part_num):
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM " + table + ";")
-            sql = "DELETE FROM " + table + " WHERE part_num = ?"
-            cur.execute(sql, (part_num,))
-            close_connection(conn)
+            with connections.transaction():
+                sql = "DELETE FROM " + table + " WHERE part_num = ?"
+                conn.execute(sql, (part_num,))
+            table_changed(table, part_num)
             return "Done"
         else:
             return None
@@ -284,19 +1001,11 @@ def convert_to_dict(table, part_num):
 
     :param table: Name of database table
     :param part_num: Part number as string
-    :return: Record of part_num
+    :return: Record of part_num or None if it is not in the database
     """
-    conn = create_connection()
-    if conn is not None:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM " + table + ";")
-        headers = [list[0] for list in cur.description]
-        part_info = search_part(table, part_num)
-        part_dict = OrderedDict(zip(headers, part_info))
-        close_connection(conn)
-        return part_dict
-    else:
-        print("Error! Unable to connect the database.")
+    part_info = search_part(table, part_num)
+    if part_info is not None:
+        return OrderedDict(zip(part_info.keys(), part_info))
 
 
 def update_part(table, part_info):
@@ -306,19 +1015,451 @@ def update_part(table, part_info):
     :param table:
     :param part_info:
     """
-    conn = create_connection()
+    conn = connections.connection()
     if conn is not None:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM " + table + ";")
-        columns = ["?" for list in cur.description]
-        sql = "REPLACE INTO " + table + " VALUES (" + ",".join(columns) + ");"
-        cur.execute(sql, part_info)
-        close_connection(conn)
+        with connections.transaction():
+            sql = (
+                "REPLACE INTO " + table
+                + " VALUES (" + table_schemas.placeholders(table) + ");"
+            )
+            conn.execute(sql, part_info)
+        table_changed(table, part_info[0])
         return "Done"
     else:
         print("Error! Unable to connect to the database.")
 
 
+SUB_COLUMNS = {
+    "hdd": "t.brand, t.part_num, t.type, t.physical_size, t.height, t.connector, \
+            t.hdd_capacity, t.ssd_capacity, t.speed, t.subbed",
+    "mem": "t.brand, t.part_num, t.connector, t.capacity, t.speed, t.subbed",
+    "cpu": "t.brand, t.part_num, t.oem_part_num, t.description, t.subbed",
+}
+
+SUB_KEY_COLUMNS = {
+    "hdd": ("connector", "type", "physical_size", "hdd_capacity", "ssd_capacity",
+            "speed"),
+    "mem": ("connector", "capacity", "speed"),
+    "cpu": ("oem_part_num",),
+}
+M2_KEY_COLUMNS = ("connector", "type", "physical_size", "ssd_capacity")
+ANCHOR_BRANDS = {"hdd": "CVO", "mem": "CVO", "cpu": "GPC"}
+
+
+def group_key_sql(kind, alias):
+    """
+    Builds the SQL expression for the sub group key of a row.  Parts
+    list_subs could match share a key; brand, height, interface and
+    do_not_sub are checked separately, so they are left out of it.
+
+    :param kind: Part type, one of hdd, mem or cpu
+    :param alias: Name the row goes by, such as NEW, OLD or t
+    :return: SQL expression
+    """
+    def joined(columns):
+        return " || char(31) || ".join(
+            "ifnull(" + alias + "." + column + ", '')" for column in columns
+        )
+
+    if kind == "hdd":
+        return (
+            "CASE WHEN " + alias + ".connector = 'm.2' THEN "
+            + joined(M2_KEY_COLUMNS)
+            + " ELSE "
+            + joined(SUB_KEY_COLUMNS[kind])
+            + " END"
+        )
+    return joined(SUB_KEY_COLUMNS[kind])
+
+
+def sub_rule_sql(table):
+    """
+    Builds the conditions a candidate row t must meet to be a sub for
+    part p once both are known to be in the same sub group.  Takes
+    one parameter, the anchor brand.
+
+    :param table: Name of database table
+    :return: SQL condition
+    """
+    sql = "t.do_not_sub = 'FALSE' AND (t.brand = ? OR t.brand = p.brand)"
+    if part_kind(table) == "hdd":
+        sql += (
+            " AND CASE WHEN p.connector = 'm.2' \
+               THEN t.interface LIKE substr(p.interface, 1, 1) || '%' \
+               ELSE (t.height = '' OR t.height = p.height) END"
+        )
+    return sql
+
+
+def has_sub_columns(table):
+    """
+    Checks that table is a part table with every column its sub group
+    key is made from.
+
+    :param table: Name of database table
+    :return: True or False
+    """
+    kind = part_kind(table)
+    return kind is not None and set(table_schemas.columns(table)).issuperset(
+        SUB_KEY_COLUMNS[kind] + ("part_num", "brand")
+    )
+
+
+def ensure_sub_groups(table, rebuild=True):
+    """
+    Creates the sub_groups and sub_group_members tables if needed and
+    the triggers that keep them current as rows of table are inserted,
+    updated and deleted.  When the triggers are new the groups are
+    built from the rows already in table.  Should be called inside a
+    transaction.
+
+    The triggers avoid ON CONFLICT clauses, since the conflict handling
+    of the statement that fires them (REPLACE in update_part) would
+    override them.
+
+    sub_groups holds one row per group: its key, how many parts are in
+    it and how many of those are the anchor brand (CVO, or GPC for
+    CPUs).  sub_group_members maps each part to its group.
+
+    :param table: Name of database table
+    :param rebuild: If False, groups already built for table are kept
+        and only the parts missing from them are added, for when rows
+        were only inserted while the triggers were dropped
+    """
+    conn = connections.connection()
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sub_groups (group_id INTEGER PRIMARY KEY, \
+           tbl, group_key, member_count, anchor_count, UNIQUE (tbl, group_key))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sub_group_members (tbl, part_num, group_id, \
+           PRIMARY KEY (tbl, part_num)) WITHOUT ROWID"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS sub_group_members_group \
+           ON sub_group_members (group_id)"
+    )
+
+    if not has_sub_columns(table):
+        return
+    sql = "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name = ?"
+    if conn.execute(sql, (table + "_sub_insert",)).fetchone()[0]:
+        return
+
+    kind = part_kind(table)
+    anchor = ANCHOR_BRANDS[kind]
+    add = (
+        "INSERT INTO sub_groups (tbl, group_key, member_count, anchor_count) \
+           SELECT '{table}', {new_key}, 0, 0 WHERE NOT EXISTS (SELECT 1 FROM sub_groups \
+             WHERE tbl = '{table}' AND group_key = {new_key}); \
+         UPDATE sub_groups SET member_count = member_count + 1, \
+           anchor_count = anchor_count + (NEW.brand IS '{anchor}') \
+           WHERE tbl = '{table}' AND group_key = {new_key}; \
+         INSERT INTO sub_group_members \
+           SELECT '{table}', NEW.part_num, group_id FROM sub_groups \
+           WHERE tbl = '{table}' AND group_key = {new_key};"
+    )
+    drop = (
+        "UPDATE sub_groups SET member_count = member_count - 1, \
+           anchor_count = anchor_count - (OLD.brand IS '{anchor}') \
+           WHERE group_id = (SELECT group_id FROM sub_group_members \
+             WHERE tbl = '{table}' AND part_num = OLD.part_num); \
+         DELETE FROM sub_groups WHERE member_count <= 0 AND group_id = \
+           (SELECT group_id FROM sub_group_members \
+             WHERE tbl = '{table}' AND part_num = OLD.part_num); \
+         DELETE FROM sub_group_members WHERE tbl = '{table}' AND part_num = OLD.part_num;"
+    )
+    triggers = {
+        "insert": "AFTER INSERT ON {table} BEGIN " + add + " END",
+        "update": "AFTER UPDATE ON {table} BEGIN " + drop + " " + add + " END",
+        "delete": "AFTER DELETE ON {table} BEGIN " + drop + " END",
+    }
+    for event, body in triggers.items():
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS " + table + "_sub_" + event + " "
+            + body.format(table=table, anchor=anchor, new_key=group_key_sql(kind, "NEW"))
+        )
+
+    if rebuild:
+        conn.execute("DELETE FROM sub_group_members WHERE tbl = ?", (table,))
+        conn.execute("DELETE FROM sub_groups WHERE tbl = ?", (table,))
+    add_sub_group_rows(table)
+
+
+def add_sub_group_rows(table):
+    """
+    Adds every part of table that is not in a sub group yet to its
+    group with a few set-based statements, creating the groups that
+    are missing and counting the new parts into the rest.  Assumes
+    parts were only inserted since the groups were last current.
+    Should be called inside a transaction.
+
+    :param table: Name of database table
+    """
+    conn = connections.connection()
+    kind = part_kind(table)
+    conn.execute("DROP TABLE IF EXISTS temp.new_members")
+    conn.execute("DROP TABLE IF EXISTS temp.new_counts")
+    conn.execute(
+        "CREATE TEMP TABLE new_members AS SELECT t.part_num, "
+        + group_key_sql(kind, "t") + " AS group_key, t.brand IS ? AS anchor FROM "
+        + table + " t WHERE NOT EXISTS (SELECT 1 FROM sub_group_members m \
+           WHERE m.tbl = ? AND m.part_num = t.part_num)",
+        (ANCHOR_BRANDS[kind], table),
+    )
+    conn.execute(
+        "CREATE TEMP TABLE new_counts (group_key PRIMARY KEY, members, anchors) \
+           WITHOUT ROWID"
+    )
+    conn.execute(
+        "INSERT INTO new_counts SELECT group_key, count(*), sum(anchor) \
+           FROM new_members GROUP BY group_key"
+    )
+    conn.execute(
+        "UPDATE sub_groups SET \
+           member_count = member_count + (SELECT members FROM new_counts c \
+             WHERE c.group_key = sub_groups.group_key), \
+           anchor_count = anchor_count + (SELECT anchors FROM new_counts c \
+             WHERE c.group_key = sub_groups.group_key) \
+           WHERE tbl = ? AND group_key IN (SELECT group_key FROM new_counts)",
+        (table,),
+    )
+    conn.execute(
+        "INSERT INTO sub_groups (tbl, group_key, member_count, anchor_count) \
+           SELECT ?, c.group_key, c.members, c.anchors FROM new_counts c \
+           WHERE NOT EXISTS (SELECT 1 FROM sub_groups g \
+             WHERE g.tbl = ? AND g.group_key = c.group_key)",
+        (table, table),
+    )
+    conn.execute(
+        "INSERT INTO sub_group_members SELECT ?, n.part_num, g.group_id \
+           FROM new_members n JOIN sub_groups g \
+           ON g.tbl = ? AND g.group_key = n.group_key",
+        (table, table),
+    )
+    conn.execute("DROP TABLE temp.new_members")
+    conn.execute("DROP TABLE temp.new_counts")
+
+
+SEARCH_COLUMNS = ("brand", "description", "oem_part_num")
+# bm25 weights for the parts_fts columns: tbl, part_num, brand,
+# description, oem_part_num.
+SEARCH_WEIGHTS = "0, 0, 2.0, 1.0, 5.0"
+
+
+def search_values_sql(columns, alias):
+    """
+    Builds the list of SEARCH_COLUMNS values of row alias for an
+    insert into parts_fts, with NULL for those table does not have.
+
+    :param columns: Column names of the table
+    :param alias: Name the row goes by, such as NEW or t
+    :return: SQL expressions joined with commas
+    """
+    return ", ".join(
+        alias + "." + column if column in columns else "NULL"
+        for column in SEARCH_COLUMNS
+    )
+
+
+def ensure_search_index(table, rebuild=True):
+    """
+    Creates the search tables and the triggers that keep them current
+    as rows of table are inserted, updated and deleted.  When the
+    triggers are new the rows already in table are indexed.  Should be
+    called inside a transaction.
+
+    part_docs gives each part a stable id the other tables refer to.
+    part_trigrams holds every three character piece of each part
+    number, lower-cased and padded with ^ and $, for similar_parts;
+    seq supplies the piece positions, as triggers cannot use WITH.
+    parts_fts is the full-text index over brand, description and OEM
+    part number.  Searches only need whole words and word prefixes, so
+    it keeps which columns a word is in but not its positions, which
+    makes it smaller and quicker to write.  It is skipped if SQLite was
+    built without FTS5, in which case search_parts falls back to LIKE.
+
+    :param table: Name of database table
+    :param rebuild: If False, rows already indexed for table are kept
+        and only the parts missing are added, see ensure_sub_groups
+    """
+    conn = connections.connection()
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS parts_fts USING fts5(tbl UNINDEXED, \
+               part_num UNINDEXED, brand, description, oem_part_num, detail = column)"
+        )
+        fts = True
+    except sqlite3.OperationalError:
+        fts = False
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS part_docs (doc_id INTEGER PRIMARY KEY, \
+           tbl, part_num, UNIQUE (tbl, part_num))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS part_trigrams (gram, doc_id, \
+           PRIMARY KEY (gram, doc_id)) WITHOUT ROWID"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS seq (n INTEGER PRIMARY KEY)")
+    conn.executemany(
+        "INSERT OR IGNORE INTO seq VALUES (?)",
+        [(n,) for n in range(1, TRIGRAM_LENGTH + 1)],
+    )
+
+    columns = table_schemas.columns(table)
+    if part_kind(table) is None or "part_num" not in columns:
+        return
+    sql = "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name = ?"
+    if conn.execute(sql, (table + "_docs_insert",)).fetchone()[0]:
+        return
+
+    add = "INSERT INTO part_docs (tbl, part_num) VALUES ('{table}', NEW.part_num); "
+    drop = ""
+    if fts:
+        add += (
+            "INSERT INTO parts_fts (rowid, tbl, part_num, brand, description, \
+               oem_part_num) SELECT doc_id, tbl, part_num, "
+            + search_values_sql(columns, "NEW")
+            + " FROM part_docs WHERE tbl = '{table}' AND part_num = NEW.part_num; "
+        )
+        drop += (
+            "DELETE FROM parts_fts WHERE rowid = (SELECT doc_id FROM part_docs \
+               WHERE tbl = '{table}' AND part_num = OLD.part_num); "
+        )
+    add += (
+        "INSERT INTO part_trigrams SELECT DISTINCT \
+           substr('^' || lower(NEW.part_num) || '$', s.n, 3), d.doc_id \
+           FROM part_docs d JOIN seq s ON s.n <= length(NEW.part_num) \
+           WHERE d.tbl = '{table}' AND d.part_num = NEW.part_num;"
+    )
+    drop += (
+        "DELETE FROM part_trigrams WHERE (gram, doc_id) IN (SELECT \
+           substr('^' || lower(OLD.part_num) || '$', s.n, 3), d.doc_id \
+           FROM part_docs d JOIN seq s ON s.n <= length(OLD.part_num) \
+           WHERE d.tbl = '{table}' AND d.part_num = OLD.part_num); \
+         DELETE FROM part_docs WHERE tbl = '{table}' AND part_num = OLD.part_num;"
+    )
+    triggers = {
+        "insert": "AFTER INSERT ON {table} BEGIN " + add + " END",
+        "update": "AFTER UPDATE ON {table} BEGIN " + drop + " " + add + " END",
+        "delete": "AFTER DELETE ON {table} BEGIN " + drop + " END",
+    }
+    for event, body in triggers.items():
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS " + table + "_docs_" + event + " "
+            + body.format(table=table)
+        )
+
+    if rebuild:
+        drop_search_rows(table)
+    add_search_rows(table)
+
+
+def add_search_rows(table):
+    """
+    Indexes every part of table that is not in the search tables yet
+    with a few set-based statements.  New part_docs rows always get
+    ids above the highest existing one, so the full-text and trigram
+    rows are only built for those, and the trigrams are written in key
+    order, which is far quicker than in the order they are made.
+    Assumes parts were only inserted since the index was last current.
+    Should be called inside a transaction.
+
+    :param table: Name of database table
+    """
+    conn = connections.connection()
+    last = conn.execute("SELECT ifnull(max(doc_id), 0) FROM part_docs").fetchone()[0]
+    conn.execute(
+        "INSERT INTO part_docs (tbl, part_num) SELECT ?, t.part_num FROM " + table
+        + " t WHERE NOT EXISTS (SELECT 1 FROM part_docs d \
+           WHERE d.tbl = ? AND d.part_num = t.part_num)",
+        (table, table),
+    )
+    if table_exists("parts_fts"):
+        conn.execute(
+            "INSERT INTO parts_fts (rowid, tbl, part_num, brand, description, \
+               oem_part_num) SELECT d.doc_id, d.tbl, d.part_num, "
+            + search_values_sql(table_schemas.columns(table), "t")
+            + " FROM part_docs d JOIN " + table
+            + " t ON t.part_num = d.part_num WHERE d.doc_id > ?",
+            (last,),
+        )
+    conn.execute(
+        "INSERT OR IGNORE INTO part_trigrams SELECT \
+           substr('^' || lower(d.part_num) || '$', s.n, 3), d.doc_id \
+           FROM part_docs d JOIN seq s ON s.n <= length(d.part_num) \
+           WHERE d.doc_id > ? ORDER BY 1, 2",
+        (last,),
+    )
+
+
+def drop_search_rows(table):
+    """
+    Removes every part of table from the search tables.
+
+    :param table: Name of database table
+    """
+    conn = connections.connection()
+    if not table_exists("part_docs"):
+        return
+    if table_exists("parts_fts"):
+        conn.execute(
+            "DELETE FROM parts_fts WHERE rowid IN \
+               (SELECT doc_id FROM part_docs WHERE tbl = ?)",
+            (table,),
+        )
+    conn.execute(
+        "DELETE FROM part_trigrams WHERE (gram, doc_id) IN (SELECT \
+           substr('^' || lower(d.part_num) || '$', s.n, 3), d.doc_id \
+           FROM part_docs d JOIN seq s ON s.n <= length(d.part_num) WHERE d.tbl = ?)",
+        (table,),
+    )
+    conn.execute("DELETE FROM part_docs WHERE tbl = ?", (table,))
+
+
+def build_sub_query(table, part_dict, columns=None):
+    """
+    Builds the SELECT used to find subs for part_dict.  The other
+    members of the part's sub group are found with index lookups on
+    sub_group_members and then checked against the brand, height and
+    interface rules.
+
+    :param table: Name of database table
+    :param part_dict: Record of the part as a dict or sqlite3.Row
+    :param columns: Columns to select, defaults to SUB_COLUMNS
+    :return: Tuple of sql and values
+    """
+    if columns is None:
+        columns = SUB_COLUMNS[table[:3]]
+    sql = (
+        "SELECT "
+        + columns
+        + " FROM sub_group_members pm \
+           JOIN sub_group_members m ON m.group_id = pm.group_id JOIN "
+        + table
+        + " p ON p.part_num = pm.part_num JOIN "
+        + table
+        + " t ON t.part_num = m.part_num WHERE pm.tbl = ? AND pm.part_num = ? AND "
+        + sub_rule_sql(table)
+    )
+    values = [table, part_dict["part_num"], ANCHOR_BRANDS[part_kind(table)]]
+    return sql, values
+
+
+def sort_results(part_num, results):
+    """
+    Places part_num at index 0 of the list.
+
+    :param part_num: Part number as string
+    :param results: List of subs
+    :return: List of subs
+    """
+    for result in results:
+        if part_num in result:
+            results.insert(0, results.pop(results.index(result)))
+    return results
+
+
 def list_subs(table, part_num):
     """
     Compares to parts to see if they are valid subs.
@@ -327,161 +1468,662 @@ def list_subs(table, part_num):
     :param part_num: Part number as string
     :return: List of subs for part_num
     """
-    conn = create_connection()
-
-    def sort_results(results):
-        """Places part_num at index 0 of the list"""
-        for result in results:
-            if part_num in result:
-                results.insert(0, results.pop(results.index(result)))
-        return results
+    conn = connections.connection()
 
     if conn is not None:
-        cur = conn.cursor()
-        part_dict = convert_to_dict(table, part_num)
-        if table.startswith("hdd"):
-            if part_dict["connector"] == "m.2":
+        part_dict = search_part(table, part_num)
+        if part_dict is None:
+            return []
+        sql, values = build_sub_query(table, part_dict)
+        results = conn.execute(sql + " ORDER BY t.rowid", values).fetchall()
+        return sort_results(part_num, results)
+    else:
+        print("Error! Unable to connect to the database.")
+
+
+def is_valid_sub(table, part_num, other_part_num):
+    """
+    Checks if other_part_num is one of the subs list_subs
+    would return for part_num.
+
+    :param table: Name of database table
+    :param part_num: Part number as string
+    :param other_part_num: Part number to check as string
+    :return: True or False
+    """
+    part_dict = search_part(table, part_num)
+    if part_dict is not None and part_in_db(table, other_part_num):
+        sql, values = build_sub_query(table, part_dict, "count(*)")
+        sql += " AND t.part_num = ?"
+        values.append(other_part_num)
+        conn = connections.connection()
+        return bool(conn.execute(sql, values).fetchone()[0])
+    else:
+        return False
+
+
+def list_subs_many(table, part_nums):
+    """
+    Finds the subs for every part in part_nums with one query.  The
+    part numbers are loaded into a temporary table and joined to
+    their sub groups, so the brand, height and interface rules are
+    applied by SQLite for all of them at once.
+
+    :param table: Name of database table
+    :param part_nums: Iterable of part numbers
+    :return: Dictionary of part_num -> list of subs, in the same form
+        list_subs returns.  Parts not in the database map to an
+        empty list.
+    """
+    conn = connections.connection()
+    part_nums = list(part_nums)
+    subs = {part_num: [] for part_num in part_nums}
+    if conn is None:
+        print("Error! Unable to connect to the database.")
+        return subs
+    if not table_exists(table) or not part_nums:
+        return subs
+
+    anchor = ANCHOR_BRANDS[part_kind(table)]
+    sql = (
+        "SELECT q.part_num, "
+        + SUB_COLUMNS[table[:3]]
+        + " FROM temp.lookup_parts q \
+           JOIN sub_group_members pm ON pm.tbl = ? AND pm.part_num = q.part_num \
+           JOIN sub_group_members m ON m.group_id = pm.group_id \
+           JOIN "
+        + table
+        + " p ON p.part_num = q.part_num JOIN "
+        + table
+        + " t ON t.part_num = m.part_num WHERE "
+        + sub_rule_sql(table)
+        + " ORDER BY q.part_num, t.rowid"
+    )
+
+    with connections.transaction(immediate=False):
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_parts (part_num)")
+        conn.execute("DELETE FROM temp.lookup_parts")
+        conn.executemany(
+            "INSERT INTO temp.lookup_parts VALUES (?)",
+            [(part_num,) for part_num in set(part_nums)],
+        )
+        for row in conn.execute(sql, (table, anchor)):
+            subs[row[0]].append(row[1:])
+        conn.execute("DELETE FROM temp.lookup_parts")
+
+    for part_num, results in subs.items():
+        sort_results(part_num, results)
+    return subs
+
+
+def is_valid_sub_many(table, pairs):
+    """
+    Checks many (part_num, other_part_num) pairs with a single call
+    to list_subs_many.
+
+    :param table: Name of database table
+    :param pairs: Iterable of (part_num, other_part_num) tuples
+    :return: List of True or False in the same order as pairs
+    """
+    pairs = list(pairs)
+    subs = list_subs_many(table, (pair[0] for pair in pairs))
+    sub_part_nums = {
+        part_num: {result[1] for result in results}
+        for part_num, results in subs.items()
+    }
+    return [other in sub_part_nums[part_num] for part_num, other in pairs]
+
+
+def part_sub_group(table, part_num):
+    """
+    Looks up the sub group part_num belongs to.
+
+    :param table: Name of database table
+    :param part_num: Part number as string
+    :return: Dictionary with the group_id, member_count and
+        anchor_count of the group, or None if the part is in none
+    """
+    conn = connections.connection()
+    row = conn.execute(
+        "SELECT g.group_id, g.member_count, g.anchor_count FROM sub_group_members m \
+           JOIN sub_groups g ON g.group_id = m.group_id \
+           WHERE m.tbl = ? AND m.part_num = ?",
+        (table, part_num),
+    ).fetchone()
+    if row is not None:
+        return dict(zip(("group_id", "member_count", "anchor_count"), row))
+
+
+def parts_without_subs(table):
+    """
+    Finds every part in table that list_subs would find no sub for
+    other than the part itself.  Parts alone in their sub group are
+    ruled out by member_count without looking further; the rest only
+    check the other members of their own group.
+
+    :param table: Name of database table
+    :return: Sorted list of part numbers
+    """
+    conn = connections.connection()
+    sql = (
+        "SELECT p.part_num FROM "
+        + table
+        + " p JOIN sub_group_members pm ON pm.tbl = ? AND pm.part_num = p.part_num \
+           JOIN sub_groups g ON g.group_id = pm.group_id \
+           WHERE g.member_count = 1 OR NOT EXISTS (SELECT 1 FROM sub_group_members m \
+             JOIN "
+        + table
+        + " t ON t.part_num = m.part_num \
+             WHERE m.group_id = pm.group_id AND m.part_num != p.part_num AND "
+        + sub_rule_sql(table)
+        + ") ORDER BY p.part_num"
+    )
+    anchor = ANCHOR_BRANDS[part_kind(table)]
+    return [row[0] for row in conn.execute(sql, (table, anchor))]
+
+
+def table_exists(table):
+    """
+    Checks to see if table exists in the database.
+
+    :param table: Name of database table
+    :return: True or False
+    """
+    conn = connections.connection()
+    sql = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return bool(conn.execute(sql, (table,)).fetchone()[0])
+
+
+def part_sub_status(parts):
+    """
+    Looks up the subbed and do_not_sub flags for many parts at once.
+    The (part_num, table) pairs are loaded into a temporary table
+    and joined against each part table with a single query.
+
+    :param parts: Iterable of (part_num, table) tuples
+    :return: Dictionary of (part_num, table) -> (subbed, do_not_sub),
+        or None for parts that are not in the database
+    """
+    conn = connections.connection()
+    status = {}
+    with connections.transaction(immediate=False):
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS hunt_parts (part_num, tbl)")
+        conn.execute("DELETE FROM temp.hunt_parts")
+        conn.executemany("INSERT INTO temp.hunt_parts VALUES (?, ?)", set(parts))
+        tables = [row[0] for row in conn.execute("SELECT DISTINCT tbl FROM temp.hunt_parts")]
+        for table in tables:
+            if table_exists(table):
                 sql = (
-                    "SELECT brand, part_num, type, physical_size, height, \
-                       connector, hdd_capacity, ssd_capacity, speed, subbed \
-                       FROM "
+                    "SELECT h.part_num, t.part_num IS NOT NULL, t.subbed, t.do_not_sub \
+                       FROM temp.hunt_parts h LEFT JOIN "
                     + table
-                    + " WHERE (brand = 'CVO' OR brand = ?) \
-                       AND type = ? AND physical_size = ? AND connector = ? \
-                       AND ssd_capacity = ? AND do_not_sub = 'FALSE' \
-                       AND interface like ?"
-                )
-                values = (
-                    part_dict["brand"],
-                    part_dict["type"],
-                    part_dict["physical_size"],
-                    part_dict["connector"],
-                    part_dict["ssd_capacity"],
-                    part_dict["interface"][:1] + "%",
+                    + " t ON t.part_num = h.part_num WHERE h.tbl = ?"
                 )
+                for part_num, found, subbed, do_not_sub in conn.execute(sql, (table,)):
+                    status[(part_num, table)] = (subbed, do_not_sub) if found else None
             else:
-                sql = (
-                    "SELECT brand, part_num, type, physical_size, height, \
-                       connector, hdd_capacity, ssd_capacity, speed, subbed \
-                       FROM "
-                    + table
-                    + " WHERE (brand = 'CVO' OR brand = ?) \
-                       AND type = ? AND physical_size = ? AND (height = '' \
-                       OR height = ?) AND connector = ? AND hdd_capacity = ? \
-                       AND ssd_capacity = ? AND speed = ? \
-                       AND do_not_sub = 'FALSE'"
-                )
-                values = (
-                    part_dict["brand"],
-                    part_dict["type"],
-                    part_dict["physical_size"],
-                    part_dict["height"],
-                    part_dict["connector"],
-                    part_dict["hdd_capacity"],
-                    part_dict["ssd_capacity"],
-                    part_dict["speed"],
-                )
-            cur.execute(sql, values)
-            # results = [list(filter(None, lst)) for lst in cur.fetchall()]
-            results = cur.fetchall()
-            return sort_results(results)
-        if table.startswith("mem"):
+                sql = "SELECT part_num FROM temp.hunt_parts WHERE tbl = ?"
+                for (part_num,) in conn.execute(sql, (table,)):
+                    status[(part_num, table)] = None
+        conn.execute("DELETE FROM temp.hunt_parts")
+    return status
+
+
+def search_parts(text, tables=None, limit=SEARCH_LIMIT):
+    """
+    Finds the parts whose brand, description or OEM part number contain
+    every word of text, each word matching as a prefix.  Results come
+    from the parts_fts index ranked by bm25, with OEM part number and
+    brand matches counting for more than description matches.  If
+    there is no index a LIKE scan of each table is used instead, and
+    the results are not ranked.
+
+    :param text: Words to search for
+    :param tables: Names of tables to search, defaults to every part
+        table
+    :param limit: Most results to return
+    :return: List of (table, part_num, brand, description) tuples,
+        best match first
+    """
+    conn = connections.connection()
+    words = re.findall(r"\w+", text.lower())
+    tables = part_tables() if tables is None else list(tables)
+    if not words or not tables:
+        return []
+
+    if table_exists("parts_fts"):
+        sql = (
+            "SELECT tbl, part_num, brand, description FROM parts_fts \
+               WHERE parts_fts MATCH ? AND tbl IN ("
+            + ",".join("?" for table in tables)
+            + ") ORDER BY bm25(parts_fts, "
+            + SEARCH_WEIGHTS
+            + ") LIMIT ?"
+        )
+        query = " ".join('"' + word + '"*' for word in words)
+        return conn.execute(sql, [query] + tables + [limit]).fetchall()
+
+    results = []
+    for table in tables:
+        columns = table_schemas.columns(table)
+        searched = [column for column in SEARCH_COLUMNS if column in columns]
+        if not searched:
+            continue
+        haystack = " || ' ' || ".join("ifnull(" + column + ", '')" for column in searched)
+        sql = (
+            "SELECT ?, part_num, "
+            + ("brand" if "brand" in columns else "NULL")
+            + ", "
+            + ("description" if "description" in columns else "NULL")
+            + " FROM "
+            + table
+            + " WHERE "
+            + " AND ".join(haystack + " LIKE ?" for word in words)
+            + " LIMIT ?"
+        )
+        values = [table] + ["%" + word + "%" for word in words] + [limit - len(results)]
+        results.extend(conn.execute(sql, values).fetchall())
+        if len(results) >= limit:
+            break
+    return results
+
+
+def prefix_parts(prefix, tables=None, limit=SUGGEST_LIMIT):
+    """
+    Finds part numbers starting with prefix with a range scan of each
+    table's primary key index.  If the prefix as typed finds nothing
+    it is tried again in upper case.
+
+    :param prefix: Start of a part number
+    :param tables: Names of tables to search, defaults to every part
+        table
+    :param limit: Most results to return
+    :return: List of (table, part_num) tuples in part number order
+    """
+    conn = connections.connection()
+    tables = part_tables() if tables is None else list(tables)
+    results = []
+    if not prefix:
+        return results
+    for candidate in OrderedDict.fromkeys((prefix, prefix.upper())):
+        high = candidate[:-1] + chr(ord(candidate[-1]) + 1)
+        for table in tables:
             sql = (
-                "SELECT brand, part_num, connector, capacity, speed, subbed \
-                   FROM "
-                + table
-                + " WHERE (brand = 'CVO' OR brand = ?) AND \
-                   connector = ? AND capacity = ? AND speed = ? AND \
-                   do_not_sub = 'FALSE'"
+                "SELECT ?, part_num FROM " + table
+                + " WHERE part_num >= ? AND part_num < ? ORDER BY part_num LIMIT ?"
             )
-            cur.execute(
-                sql,
-                (
-                    part_dict["brand"],
-                    part_dict["connector"],
-                    part_dict["capacity"],
-                    part_dict["speed"],
-                ),
+            results.extend(
+                conn.execute(sql, (table, candidate, high, limit - len(results)))
             )
-            results = cur.fetchall()
-            return sort_results(results)
-        if table.startswith("cpu"):
-            sql = (
-                "SELECT brand, part_num, oem_part_num, description, subbed \
-                   FROM "
-                + table
-                + " WHERE (brand = 'GPC' or brand = ?) AND \
-                    oem_part_num = ? AND do_not_sub = 'FALSE'"
+            if len(results) >= limit:
+                return results
+        if results:
+            break
+    return results
+
+
+def edit_distance(first, second, limit):
+    """
+    Counts the single character insertions, deletions and substitutions
+    needed to turn first into second, giving up once it is certain to
+    be more than limit.
+
+    :param first: String
+    :param second: String
+    :param limit: Largest distance of interest
+    :return: The distance, or limit + 1 if it is more than limit
+    """
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (first_char != second_char),
+                )
             )
-            cur.execute(sql, (part_dict["brand"], part_dict["oem_part_num"]))
-            results = cur.fetchall()
-        close_connection(conn)
-        return sort_results(results)
-    else:
-        print("Error! Unable to connect to the database.")
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
 
 
-def is_valid_sub(table, part_num, other_part_num):
+def similar_parts(text, tables=None, max_edits=2, limit=SUGGEST_LIMIT):
+    """
+    Finds part numbers within max_edits typos of text, ignoring case.
+    A part number that close must share all but 3 * max_edits of the
+    three character pieces of text, so candidates are found in
+    part_trigrams by counting shared pieces and only the best
+    CANDIDATE_LIMIT are checked with edit_distance.
+
+    :param text: Part number as typed
+    :param tables: Names of tables to search, defaults to every part
+        table
+    :param max_edits: Most typos allowed
+    :param limit: Most results to return
+    :return: List of (table, part_num, distance) tuples, closest first
+    """
+    conn = connections.connection()
+    tables = part_tables() if tables is None else list(tables)
+    text = text.lower()
+    if not text or not tables or not table_exists("part_trigrams"):
+        return []
+
+    padded = "^" + text + "$"
+    grams = sorted({padded[i:i + 3] for i in range(len(padded) - 2)})
+    sql = (
+        "SELECT d.tbl, d.part_num FROM part_trigrams g \
+           JOIN part_docs d ON d.doc_id = g.doc_id WHERE g.gram IN ("
+        + ",".join("?" for gram in grams)
+        + ") AND d.tbl IN ("
+        + ",".join("?" for table in tables)
+        + ") GROUP BY g.doc_id HAVING count(*) >= ? ORDER BY count(*) DESC LIMIT ?"
+    )
+    values = grams + tables + [max(1, len(grams) - 3 * max_edits), CANDIDATE_LIMIT]
+
+    results = []
+    for table, part_num in conn.execute(sql, values):
+        distance = edit_distance(text, part_num.lower(), max_edits)
+        if distance <= max_edits:
+            results.append((table, part_num, distance))
+    results.sort(key=lambda result: (result[2], result[1]))
+    return results[:limit]
+
+
+def suggest_parts(text, tables=None, limit=SUGGEST_LIMIT):
+    """
+    Suggests part numbers for what has been typed so far: those that
+    start with it, then those within two typos of it.
+
+    :param text: Part number as typed
+    :param tables: Names of tables to search, defaults to every part
+        table
+    :param limit: Most results to return
+    :return: List of (table, part_num) tuples
+    """
+    results = OrderedDict.fromkeys(prefix_parts(text, tables, limit))
+    if len(results) < limit:
+        for table, part_num, distance in similar_parts(text, tables, limit=limit):
+            results[(table, part_num)] = None
+    return list(results)[:limit]
+
+
+def clean_rows(reader, width):
+    """
+    Yields the rows of reader one at a time with trailing non-breaking
+    spaces stripped.  Blank lines are skipped and every row is padded
+    or cut to width values.
+
+    :param reader: csv reader positioned after the header row
+    :param width: Number of columns in the table
+    """
+    for row in reader:
+        if not row:
+            continue
+        row = [item.strip() if item.endswith("\xa0") else item for item in row]
+        if len(row) < width:
+            row.extend([None] * (width - len(row)))
+        yield row[:width]
+
+
+def chunked(rows, size):
+    """
+    Groups rows into lists of at most size rows.
+
+    :param rows: Iterable of rows
+    :param size: Rows per chunk
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def insert_rows(table, headers, rows):
     """
-    Calls list_subs and then checks in other_part_num is
-    in the list of subs returns.
+    Inserts rows into table, skipping part numbers that are already
+    there.  Should be called inside a transaction.
 
     :param table: Name of database table
-    :param part_num: Part number as string
-    :param other_part_num: Part number to check as string
-    :return: True or False
+    :param headers: Column names of table
+    :param rows: List of rows to insert
+    :return: Number of rows inserted
+    """
+    conn = connections.connection()
+    cur = conn.cursor()
+    columns = ["?" for item in headers]
+    cur.executemany(
+        "INSERT OR IGNORE INTO " + table + " VALUES (" + ",".join(columns) + ")",
+        rows,
+    )
+    return cur.rowcount
+
+
+def drop_part_triggers(table):
+    """
+    Drops the triggers that keep the sub groups and search index of
+    table current.  ensure_part_table puts them back and, as they are
+    then new, brings both up to date with the rows in table.
+
+    :param table: Name of database table
+    """
+    conn = connections.connection()
+    for prefix in ("_sub_", "_docs_"):
+        for event in ("insert", "update", "delete"):
+            conn.execute("DROP TRIGGER IF EXISTS " + table + prefix + event)
+
+
+@contextmanager
+def bulk_load(table):
+    """
+    Suspends the per-row triggers of table while the enclosed block
+    inserts rows into it, then adds the new rows to the sub groups and
+    search index with a few set-based statements.  The block must only
+    insert.  Must be used inside a transaction, so a failed load
+    brings the triggers back with the rollback.
+
+    :param table: Name of database table
+    """
+    drop_part_triggers(table)
+    yield
+    ensure_part_table(table, rebuild=False)
+
+
+def prepare_import_table(table, headers):
+    """
+    Creates the table an import writes into if it does not exist yet.
+
+    :param table: Name of database table
+    :param headers: Column names from the CSV header row
     """
-    if part_in_db(table, part_num) and part_in_db(table, other_part_num):
-        subs = list_subs(table, part_num)
-        return any(lst[1] == other_part_num for lst in subs)
+    if part_kind(table):
+        create_part_table(table, headers)
     else:
-        return False
+        create_table(
+            "CREATE TABLE IF NOT EXISTS "
+            + table
+            + "(part_num PRIMARY KEY,"
+            + ",".join(headers[1:])
+            + ");"
+        )
+        table_schemas.forget(table)
 
 
-def import_from_csv(file):
+def import_from_csv(file, chunk_size=IMPORT_CHUNK_SIZE):
     """
-    Import lines from file into SQLite3 database.
+    Import lines from file into SQLite3 database.  The file is read
+    and inserted chunk_size rows at a time inside one transaction, so
+    memory use does not grow with the size of the file.  The sub
+    groups and search index are brought up to date once at the end
+    rather than row by row, see bulk_load.
 
     :param file: File to import.
+    :param chunk_size: Rows to insert per executemany call
+    :return: Dictionary with the table name, rows read, rows
+        inserted, rows ignored, seconds taken and rows per second
     """
-    conn = create_connection()
+    conn = connections.connection()
 
     if conn is not None:
         table = basename(file).lower()[:-4]
-        with open(file, "r") as csvfile:
-            reader = csv_DictReader(csvfile)
-            first_row = next(reader)
-            headers = [header for header, value in first_row.items()]
-            headers[0] = "part_num PRIMARY KEY"
-
-            create_table(
-                "CREATE TABLE IF NOT EXISTS " + table + "(" + ",".join(headers) + ");"
-            )
+        stats = {"table": table, "rows": 0, "inserted": 0}
+        start = perf_counter()
+        with open(file, "r", newline="") as csvfile:
+            reader = csvreader(csvfile)
+            headers = next(reader, None)
+            if headers:
+                headers[0] = "part_num"
+                with connections.transaction():
+                    prepare_import_table(table, headers)
+                    with bulk_load(table):
+                        for chunk in chunked(clean_rows(reader, len(headers)), chunk_size):
+                            stats["rows"] += len(chunk)
+                            stats["inserted"] += insert_rows(table, headers, chunk)
+                table_changed(table)
+                analyze_tables([table])
+        connections.checkpoint("TRUNCATE")
+        stats["ignored"] = stats["rows"] - stats["inserted"]
+        stats["seconds"] = perf_counter() - start
+        stats["rows_per_sec"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+        return stats
+    else:
+        print("Error! Unable to connect to the database.")
 
-            to_import = [list(row.values()) for row in reader]
-            to_import.append(list(first_row.values()))
-
-            for list_item in to_import:
-                for item in list_item:
-                    if item.endswith("\xa0"):
-                        index_of_list = to_import.index(list_item)
-                        index_of_item = list_item.index(item)
-                        to_import[index_of_list][index_of_item] = item.strip()
-
-            cur = conn.cursor()
-            columns = ["?" for item in headers]
-            cur.executemany(
-                "INSERT OR IGNORE INTO "
-                + table
-                + " VALUES ("
-                + ",".join(columns)
-                + ")",
-                to_import,
-            )
 
-            close_connection(conn)
-    else:
+_import_queue = None
+
+
+def _init_import_worker(queue):
+    """Gives a worker process the queue it sends parsed rows through."""
+    global _import_queue
+    _import_queue = queue
+
+
+def parse_csv_file(file, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Reads and cleans file in an import_directory worker process and
+    sends it to the writer a chunk at a time.  Nothing is written to
+    the database here.
+
+    :param file: CSV file to parse
+    :param chunk_size: Rows per chunk sent to the writer
+    """
+    try:
+        with open(file, "r", newline="") as csvfile:
+            reader = csvreader(csvfile)
+            headers = next(reader, None)
+            if headers:
+                headers[0] = "part_num"
+                _import_queue.put(("start", file, headers))
+                for chunk in chunked(clean_rows(reader, len(headers)), chunk_size):
+                    _import_queue.put(("rows", file, chunk))
+        _import_queue.put(("done", file, None))
+    except Exception as e:
+        _import_queue.put(("error", file, repr(e)))
+
+
+def import_directory(directory, processes=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Imports every CSV file in directory.  Files are parsed in a pool
+    of worker processes while this process is the only one writing
+    to the database, committing one chunk at a time to the table
+    named after each file.  As chunks are committed separately the
+    per-row triggers are dropped when a table's first file starts and
+    the sub groups and search index of each table are brought up to
+    date once every file is done, even if the import fails part way.
+    Should the process die first, restore_part_triggers puts them back
+    the next time the database is opened.
+
+    :param directory: Folder holding the CSV files
+    :param processes: Number of parser processes, defaults to the
+        number of CPUs
+    :param chunk_size: Rows per chunk
+    :return: List with a dictionary per file holding the file, table,
+        rows read, rows inserted, rows ignored and any error
+    """
+    conn = connections.connection()
+    if conn is None:
         print("Error! Unable to connect to the database.")
+        return None
+
+    summary = OrderedDict()
+    for file in sorted(glob(pathjoin(directory, "*.csv"))):
+        summary[file] = {
+            "file": file,
+            "table": basename(file).lower()[:-4],
+            "rows": 0,
+            "inserted": 0,
+            "error": None,
+        }
+    if not summary:
+        return []
+
+    processes = processes or cpu_count()
+    queue = Queue(maxsize=processes * 4)
+    suspended = set()
+    pool = Pool(min(processes, len(summary)), _init_import_worker, (queue,))
+    try:
+        result = pool.map_async(partial(parse_csv_file, chunk_size=chunk_size), summary)
+        headers = {}
+        remaining = len(summary)
+        while remaining:
+            try:
+                message, file, payload = queue.get(timeout=1)
+            except Empty:
+                if result.ready() and not result.successful():
+                    result.get()
+                continue
+            stats = summary[file]
+            if message in ("done", "error"):
+                if message == "error":
+                    stats["error"] = payload
+                remaining -= 1
+            elif stats["error"] is not None:
+                continue
+            elif message == "start":
+                try:
+                    with connections.transaction():
+                        prepare_import_table(stats["table"], payload)
+                        drop_part_triggers(stats["table"])
+                    suspended.add(stats["table"])
+                    headers[file] = payload
+                except sqlite3.Error as e:
+                    stats["error"] = repr(e)
+            elif message == "rows":
+                stats["rows"] += len(payload)
+                try:
+                    with connections.transaction():
+                        stats["inserted"] += insert_rows(
+                            stats["table"], headers[file], payload
+                        )
+                    table_changed(stats["table"])
+                except sqlite3.Error as e:
+                    stats["error"] = repr(e)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for table in sorted(suspended):
+            with connections.transaction():
+                ensure_part_table(table, rebuild=False)
+
+    analyze_tables(
+        sorted({stats["table"] for stats in summary.values() if stats["inserted"]})
+    )
+    connections.checkpoint("TRUNCATE")
+    for stats in summary.values():
+        stats["ignored"] = stats["rows"] - stats["inserted"]
+    return list(summary.values())
 
 
 def csv_writer(file, rows):
@@ -0,0 +1,442 @@
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+from csv import writer as csvwriter
+from os import makedirs
+from os.path import dirname, exists
+from os.path import join as pathjoin
+from shutil import rmtree
+from time import perf_counter
+
+from backend import (SCHEMAS, connections, filter_columns, import_from_csv,
+                     is_valid_sub, list_subs, record_cache,
+                     return_possible_values, table_changed)
+from auto_hunt import (BRANDS, PART_TYPES, REPAIR_LOCS, filter_data,
+                       get_part_type_index, purge_subbed, read_report,
+                       save_to_file)
+
+
+SCALES = {"10k": 10000, "100k": 100000, "1m": 1000000}
+SEED = 2018
+QUERIES = 200
+REPEAT = 3
+THRESHOLD = 0.25
+# Timings shorter than this are mostly noise, so they are never
+# reported as regressions however large the ratio.
+MIN_DELTA = 0.01
+RESULTS_DIR = "benchmarks"
+
+# Value pools for the generated catalogues.  The anchor brands are
+# listed so that list_subs has sub candidates to return.
+HDD_VALUES = {
+    "brand": ("CVO", "Lenovo", "Dell", "HP", "Seagate", "WD", "Toshiba"),
+    "connector": ("SATA", "SATA", "SATA", "m.2", "SAS"),
+    "hdd_capacity": ("", "320", "500", "1000", "2000"),
+    "ssd_capacity": ("", "8", "128", "256", "512"),
+    "speed": ("", "5400", "7200"),
+    "type": ("HDD", "HDD", "SSD", "SSHD"),
+    "physical_size": ("2.5", "3.5"),
+    "height": ("", "7", "9.5"),
+    "interface": ("SATA III", "SATA II", "PCIe", "NVMe"),
+}
+MEM_VALUES = {
+    "speed": ("PC3-10600S", "PC3-12800S", "PC4-17000S", "PC4-19200S",
+              "PC4-21300S", "PC4-25600S"),
+    "brand": ("CVO", "Lenovo", "Dell", "HP", "Samsung", "Hynix", "Micron"),
+    "connector": ("SO-DIMM", "DIMM"),
+    "capacity": ("2GB", "4GB", "8GB", "16GB", "32GB"),
+}
+CPU_VALUES = {
+    "brand": ("GPC", "Lenovo", "Dell", "HP", "Intel", "AMD"),
+    "model": ("I3-7100U", "I5-8250U", "I7-8550U", "I7-3632QM", "FX-770K",
+              "RYZEN 5 2500U"),
+}
+PART_PREFIXES = {"hdd": "1", "mem": "2", "cpu": "3"}
+WARRANTIES = ("MFG Warranty", "MFG Warranty", "Non-Warranty", "Extended")
+# Share of openPO rows ordering parts missing from the database.
+UNKNOWN_SHARE = 0.05
+
+
+def part_numbers(rng, kind, count):
+    """
+    Returns count distinct seven digit part numbers for kind, in a
+    random order so rows are not inserted in key order.
+
+    :param rng: random.Random instance
+    :param kind: Part type, one of hdd, mem or cpu
+    :param count: How many part numbers to make
+    :return: List of part numbers
+    """
+    return [PART_PREFIXES[kind] + "{:07d}".format(n)
+            for n in rng.sample(range(10 ** 7), count)]
+
+
+def hdd_row(rng, part_num):
+    """Returns one generated hdd row as a dictionary."""
+    row = {column: rng.choice(values) for column, values in HDD_VALUES.items()}
+    row["description"] = "{} {} {}GB {}".format(
+        row["brand"], row["type"], row["hdd_capacity"] or row["ssd_capacity"],
+        row["connector"])
+    return common_values(row, part_num, rng)
+
+
+def common_values(row, part_num, rng):
+    """Fills in the columns every part type shares and returns row."""
+    row["part_num"] = part_num
+    row["do_not_sub"] = "TRUE" if rng.random() < 0.05 else "FALSE"
+    row["subbed"] = "TRUE" if rng.random() < 0.5 else "FALSE"
+    return row
+
+
+def mem_row(rng, part_num):
+    """Returns one generated mem row as a dictionary."""
+    row = {column: rng.choice(values) for column, values in MEM_VALUES.items()}
+    row["description"] = "{} {} {}".format(row["capacity"], row["speed"],
+                                           row["connector"])
+    return common_values(row, part_num, rng)
+
+
+def cpu_row(rng, part_num, oem_count):
+    """
+    Returns one generated cpu row.  cpu subs share an oem_part_num, so
+    it is drawn from oem_count values to give groups of a few parts.
+    """
+    model = rng.choice(CPU_VALUES["model"])
+    row = {
+        "brand": rng.choice(CPU_VALUES["brand"]),
+        "oem_part_num": "SR{:05d}".format(rng.randrange(oem_count)),
+    }
+    row["description"] = "CPU {} {}.{}GHz".format(
+        model, rng.randint(1, 4), rng.randint(0, 9))
+    return common_values(row, part_num, rng)
+
+
+def generate_catalogue(directory, kind, count, seed=SEED):
+    """
+    Writes a catalogue of count generated parts to <kind>_bench.csv in
+    directory, one row at a time.  The same seed always gives the same
+    file.
+
+    :param directory: Folder to write the csv file in
+    :param kind: Part type, one of hdd, mem or cpu
+    :param count: Number of rows
+    :param seed: Seed for the generator
+    :return: Path of the csv file and the list of part numbers in it
+    """
+    rng = random.Random("{}-{}".format(seed, kind))
+    parts = part_numbers(rng, kind, count)
+    headers = SCHEMAS[kind]
+    file = pathjoin(directory, kind + "_bench.csv")
+    with open(file, "w", newline="") as csvfile:
+        writer = csvwriter(csvfile)
+        writer.writerow(headers)
+        for part_num in parts:
+            if kind == "hdd":
+                row = hdd_row(rng, part_num)
+            elif kind == "mem":
+                row = mem_row(rng, part_num)
+            else:
+                row = cpu_row(rng, part_num, max(count // 5, 1))
+            writer.writerow([row[column] for column in headers])
+    return file, parts
+
+
+def generate_report(directory, catalogues, seed=SEED):
+    """
+    Writes a tab-delimited openPO report and the allHDD/allMEM/allCPU
+    files auto_hunt reads.  The report has as many rows as one
+    catalogue.  Most rows order catalogue parts; some
+    order parts known to parts_in_sp but missing from the database,
+    and some fail validate on their repair location or brand.
+
+    :param directory: Folder to write the files in
+    :param catalogues: Dictionary of part type to list of part numbers
+    :param seed: Seed for the generator
+    :return: Path of the report and of the parts_in_sp folder
+    """
+    rng = random.Random("{}-report".format(seed))
+    parts_dir = pathjoin(directory, "parts_in_sp")
+    makedirs(parts_dir)
+    known = []
+    for part_type in PART_TYPES:
+        parts = catalogues[part_type.lower()]
+        unknown = ["9" + part_num[1:] for part_num in
+                   parts[:max(int(len(parts) * UNKNOWN_SHARE), 1)]]
+        with open(pathjoin(parts_dir, "all" + part_type + ".csv"), "w",
+                  newline="") as csvfile:
+            writer = csvwriter(csvfile)
+            for part_num in parts + unknown:
+                writer.writerow([part_num])
+        known.append((parts, unknown))
+
+    file = pathjoin(directory, "openPO.txt")
+    rows = len(known[0][0])
+    with open(file, "w", newline="") as csvfile:
+        writer = csvwriter(csvfile, delimiter="\t")
+        writer.writerow(["Col " + str(n) for n in range(32)])
+        for so_num in range(rows):
+            parts, unknown = rng.choice(known)
+            if rng.random() < UNKNOWN_SHARE:
+                part_num = rng.choice(unknown)
+            else:
+                part_num = rng.choice(parts)
+            warranty = rng.choice(WARRANTIES)
+            row = [""] * 32
+            row[0] = rng.choice(REPAIR_LOCS + ("999",))
+            row[13] = "SO{:08d}".format(so_num)
+            row[14] = warranty
+            row[15] = warranty
+            row[21] = rng.choice(BRANDS + ("XXX",))
+            row[31] = part_num
+            writer.writerow(row)
+    return file, parts_dir
+
+
+def timed(function, *args, repeat=REPEAT):
+    """
+    Calls function repeat times and returns the fastest time along
+    with the result of the last call.
+
+    :param function: Function to time
+    :param args: Arguments for function
+    :param repeat: Number of calls
+    :return: Tuple of seconds and result
+    """
+    best = None
+    for _ in range(repeat):
+        record_cache.clear()
+        start = perf_counter()
+        result = function(*args)
+        seconds = perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+
+def loop(function, calls):
+    """
+    Returns a function that runs function over each tuple of
+    arguments in calls, for timing a batch of lookups at once.
+    """
+    def run():
+        for args in calls:
+            function(*args)
+        return len(calls)
+    return run
+
+
+def run_benchmarks(scale, seed=SEED, queries=QUERIES, processes=0):
+    """
+    Generates the catalogues and openPO report for scale in a
+    temporary folder, points the backend at a fresh database there
+    and times each function.
+
+    :param scale: One of the keys of SCALES
+    :param seed: Seed for the generator
+    :param queries: Number of list_subs and is_valid_sub calls timed
+    :param processes: Worker processes for purge_subbed
+    :return: Dictionary of results, ready to be saved as JSON
+    """
+    count = SCALES[scale]
+    rng = random.Random("{}-queries".format(seed))
+    timings = {}
+
+    def record(name, seconds, calls=1):
+        timings[name] = {"seconds": round(seconds, 6), "calls": calls,
+                         "per_call": round(seconds / calls, 6)}
+        print("{:<40} {:>10.4f}s".format(name, seconds))
+
+    directory = tempfile.mkdtemp(prefix="partdb-bench-")
+    try:
+        connections.close()
+        connections.database = pathjoin(directory, "bench.db")
+        connections.upgraded = False
+
+        catalogues = {}
+        files = {}
+        for kind in SCHEMAS:
+            files[kind], catalogues[kind] = generate_catalogue(
+                directory, kind, count, seed)
+        report, parts_dir = generate_report(directory, catalogues, seed)
+
+        for kind in SCHEMAS:
+            seconds, _ = timed(import_from_csv, files[kind], repeat=1)
+            record("import_from_csv[" + kind + "]", seconds)
+
+        for kind in SCHEMAS:
+            table = kind + "_bench"
+            parts = rng.sample(catalogues[kind], min(queries, count))
+            others = rng.sample(catalogues[kind], min(queries, count))
+            calls = [(table, part_num) for part_num in parts]
+            seconds, _ = timed(loop(list_subs, calls))
+            record("list_subs[" + kind + "]", seconds, len(calls))
+            calls = [(table, part_num, other)
+                     for part_num, other in zip(parts, others)]
+            seconds, _ = timed(loop(is_valid_sub, calls))
+            record("is_valid_sub[" + kind + "]", seconds, len(calls))
+
+        filters = {
+            "hdd": {"connector": "SATA", "type": "SSD", "physical_size": "2.5"},
+            "mem": {"connector": "SO-DIMM", "capacity": "8GB"},
+            "cpu": {"brand": "GPC"},
+        }
+        for kind, my_dict in filters.items():
+            seconds, _ = timed(filter_columns, kind + "_bench", my_dict)
+            record("filter_columns[" + kind + "]", seconds)
+
+        def possible_values(table, columns):
+            for column in columns:
+                table_changed(table)
+                return_possible_values(table, column)
+            return len(columns)
+
+        for kind in SCHEMAS:
+            columns = [column for column in SCHEMAS[kind] if column != "part_num"]
+            seconds, _ = timed(possible_values, kind + "_bench", columns)
+            record("return_possible_values[" + kind + "]", seconds, len(columns))
+
+        part_nums = list(filter_data(read_report(report),
+                                     get_part_type_index(parts_dir)))
+        seconds, purged = timed(purge_subbed, part_nums, processes)
+        record("purge_subbed", seconds, len(part_nums))
+
+        hunts = pathjoin(directory, "hunts")
+        makedirs(hunts)
+        seconds, _ = timed(save_to_file, purged, hunts)
+        record("save_to_file", seconds, len(purged))
+    finally:
+        connections.close()
+        rmtree(directory, ignore_errors=True)
+
+    return {
+        "scale": scale,
+        "rows": count,
+        "seed": seed,
+        "queries": queries,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "timings": timings,
+    }
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compares each timing in results with the same timing in baseline.
+    A timing regresses when it is more than threshold slower, as a
+    fraction of the baseline, and slower by at least MIN_DELTA
+    seconds.
+
+    :param results: Dictionary from run_benchmarks
+    :param baseline: Dictionary from an earlier run_benchmarks
+    :param threshold: Allowed slowdown, 0.25 is 25%
+    :return: List of (name, baseline seconds, seconds, ratio) for each
+        regression
+    """
+    regressions = []
+    for name, timing in sorted(results["timings"].items()):
+        before = baseline["timings"].get(name)
+        if before is None:
+            continue
+        ratio = timing["seconds"] / before["seconds"] if before["seconds"] else 0
+        slower = timing["seconds"] - before["seconds"]
+        if ratio > 1 + threshold and slower >= MIN_DELTA:
+            regressions.append((name, before["seconds"], timing["seconds"], ratio))
+    return regressions
+
+
+def result_path(scale, kind, directory=RESULTS_DIR):
+    """
+    Returns the path the results or baseline for scale are saved to.
+
+    :param scale: One of the keys of SCALES
+    :param kind: "results" or "baseline"
+    :param directory: Folder the JSON files are saved in
+    """
+    return pathjoin(directory, scale + " " + kind + ".json")
+
+
+def main(argv=None):
+    """
+    Runs the benchmarks from the command line, e.g.
+
+        python benchmark.py --scale 100k
+        python benchmark.py --scale 100k --save-baseline
+
+    :param argv: Command line arguments, defaults to sys.argv
+    :return: Exit status, 0 on success and 1 if anything regressed or
+        there was no baseline to compare against
+    """
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Time the backend and auto hunt on generated catalogues.",
+    )
+    parser.add_argument("--scale", choices=sorted(SCALES, key=SCALES.get),
+                        default="10k",
+                        help="rows per catalogue (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=SEED,
+                        help="seed for the generated data (default: %(default)s)")
+    parser.add_argument("--queries", type=int, default=QUERIES,
+                        help="list_subs and is_valid_sub calls per part type "
+                             "(default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="worker processes for purge_subbed "
+                             "(default: %(default)s)")
+    parser.add_argument("--out", default=None,
+                        help="JSON file to save the results in "
+                             "(default: benchmarks/<scale> results.json)")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON file to compare against "
+                             "(default: benchmarks/<scale> baseline.json)")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed slowdown before failing, as a fraction "
+                             "(default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save the results as the new baseline")
+    args = parser.parse_args(argv)
+
+    out = args.out or result_path(args.scale, "results")
+    baseline_file = args.baseline or result_path(args.scale, "baseline")
+
+    if not args.save_baseline and not exists(baseline_file):
+        print("Warning! No baseline at " + baseline_file + ", the results "
+              "will not be compared.", file=sys.stderr)
+
+    results = run_benchmarks(args.scale, args.seed, args.queries, args.processes)
+
+    for file in [out] + ([baseline_file] if args.save_baseline else []):
+        if dirname(file):
+            makedirs(dirname(file), exist_ok=True)
+        with open(file, "w") as jsonfile:
+            json.dump(results, jsonfile, indent=2, sort_keys=True)
+        print("Saved " + file)
+
+    if args.save_baseline:
+        return 0
+    if not exists(baseline_file):
+        print("Error! No baseline at " + baseline_file + ", nothing compared.  "
+              "Run with --save-baseline to store one.", file=sys.stderr)
+        return 1
+
+    with open(baseline_file, "r") as jsonfile:
+        baseline = json.load(jsonfile)
+    if (baseline.get("scale"), baseline.get("seed")) != (args.scale, args.seed):
+        print("Error! " + baseline_file + " was made with a different scale "
+              "or seed.", file=sys.stderr)
+        return 1
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, after, ratio in regressions:
+        print("Regressed: {} {:.4f}s -> {:.4f}s ({:.0%} slower)".format(
+            name, before, after, ratio - 1), file=sys.stderr)
+    if regressions:
+        return 1
+    print("No regressions against " + baseline_file)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
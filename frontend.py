@@ -1,6 +1,5 @@
 """Displays the GUI for SubHunt."""
 import tkinter as tk
-from csv import reader as csvreader
 from tkinter import ttk, messagebox, filedialog
 from tkinter.ttk import Treeview, Scrollbar
 from os.path import basename
@@ -8,12 +7,17 @@ from openpyxl import load_workbook
 from threading import Thread
 from collections import OrderedDict
 
-from auto_hunt import copy_file, purge_subbed, get_type, save_to_file, get_all_parts
+from auto_hunt import copy_file, hunt, save_to_file, get_all_parts
 from backend import (
+    connections,
     remove_table,
-    return_table,
+    count_rows,
+    return_page,
+    iter_pages,
+    PAGE_SIZE,
     return_column_names,
-    return_possible_values,
+    facet_columns,
+    facet_counts,
     part_in_db,
     add_part,
     remove_part,
@@ -21,11 +25,17 @@ from backend import (
     update_part,
     list_subs,
     is_valid_sub,
+    search_parts,
+    suggest_parts,
     import_from_csv,
-    filter_columns,
+    import_directory,
     csv_writer,
 )
 
+# Milliseconds to wait after the last key press before suggesting
+# part numbers.
+SUGGEST_DELAY = 250
+
 
 def clear_widgets(frame):
     """Removes all widgets from frame."""
@@ -33,6 +43,78 @@ def clear_widgets(frame):
         widget.destroy()
 
 
+def not_found_message(table, part_num):
+    """
+    Builds the error shown when part_num is not in table, listing the
+    closest part numbers that are.
+
+    :param table: Name of database table
+    :param part_num: Part number that was entered
+    :return: Message as string
+    """
+    message = part_num + " does not exist in the database."
+    suggestions = suggest_parts(part_num, [table], limit=5)
+    if suggestions:
+        message += "\n\nDid you mean:\n" + "\n".join(
+            suggestion[1] for suggestion in suggestions
+        )
+    return message
+
+
+class SuggestionBox:
+    """
+    Lists part numbers matching what has been typed into an entry in a
+    box under it, updated as the user types.  Clicking one fills it in.
+    """
+
+    def __init__(self, entry, tables):
+        """
+        :param entry: Entry widget part numbers are typed into
+        :param tables: Function returning the names of the tables to
+            look in
+        """
+        self.entry = entry
+        self.tables = tables
+        self.pending = None
+        self.listbox = tk.Listbox(entry.master, height=6)
+        self.listbox.bind("<<ListboxSelect>>", self.pick)
+        entry.bind("<KeyRelease>", self.on_key, add="+")
+        entry.bind("<FocusOut>", lambda event: entry.after(200, self.hide), add="+")
+
+    def on_key(self, event):
+        """Waits for a pause in typing before looking anything up."""
+        if self.pending is not None:
+            self.entry.after_cancel(self.pending)
+            self.pending = None
+        if event.keysym in ("Return", "Escape"):
+            self.hide()
+        else:
+            self.pending = self.entry.after(SUGGEST_DELAY, self.refresh)
+
+    def refresh(self):
+        self.pending = None
+        text = self.entry.get().strip()
+        suggestions = suggest_parts(text, self.tables()) if len(text) >= 2 else []
+        self.listbox.delete(0, tk.END)
+        if not suggestions:
+            self.hide()
+            return
+        for table, part_num in suggestions:
+            self.listbox.insert(tk.END, part_num)
+        self.listbox.place(in_=self.entry, x=0, rely=1, relwidth=1)
+        self.listbox.lift()
+
+    def pick(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.entry.delete(0, tk.END)
+            self.entry.insert(0, self.listbox.get(selection[0]))
+        self.hide()
+
+    def hide(self):
+        self.listbox.place_forget()
+
+
 class Main(tk.Tk):
     """Displays initial state of GUI."""
 
@@ -44,6 +126,7 @@ class Main(tk.Tk):
 
         self.file_menu = tk.Menu(self.menu, tearoff=False)
         self.file_menu.add_command(label="Import", command=self.import_list)
+        self.file_menu.add_command(label="Import Folder", command=self.import_folder)
         self.file_menu.add_command(
             label="Purge Records", command=lambda: self.show_frame("PurgePage")
         )
@@ -109,6 +192,13 @@ class Main(tk.Tk):
             frame.grid(row=0, column=0, sticky="nsew")
 
         self.show_frame("MainPage")
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def on_close(self):
+        """Empties the database's WAL file before the window closes."""
+        connections.checkpoint("TRUNCATE")
+        connections.close()
+        self.destroy()
 
     def show_frame(self, page_name):
         """Show a frame for the given page name"""
@@ -122,7 +212,30 @@ class Main(tk.Tk):
         )
 
         if file != "":
-            import_from_csv(file)
+            stats = import_from_csv(file)
+            if stats:
+                messagebox.showinfo(
+                    "Import Complete",
+                    "{inserted} of {rows} rows imported into {table} "
+                    "({rows_per_sec:.0f} rows/sec).".format(**stats),
+                )
+
+    def import_folder(self):
+        """Opens a dialog window to pick a folder of CSV files for import"""
+        directory = filedialog.askdirectory(title="Import Folder")
+
+        if directory:
+            summary = import_directory(directory)
+            if summary:
+                messagebox.showinfo(
+                    "Import Complete",
+                    "\n".join(
+                        "{table}: {rows} read, {inserted} inserted, "
+                        "{ignored} ignored".format(**stats)
+                        + (" ({error})".format(**stats) if stats["error"] else "")
+                        for stats in summary
+                    ),
+                )
 
     def automate_sub_hunt(self):
         """
@@ -130,56 +243,22 @@ class Main(tk.Tk):
         completes the auto-hunt.
         """
 
-        def validate(row, all_parts):
-            repair_locs = ["1320", "622", "630", "68", "67",
-                            "69", "610", "615", "618", "624"]
-            brands = ("ACE", "ALI", "ASU", "DEL", "GWY", "HEW", "LNV",
-                      "MSS", "RCM", "RZR", "SAC", "SYC", "TSC",)
-
-            if row[0] not in repair_locs:
-                return False
-            if get_type(row[31], all_parts) is None:
-                return False
-            if row[21] not in brands:
-                return False
-            if row[14] is None:
-                return False
-            if row[15] != row[14]:
-                return False
-                
-            return True
-
-        def filter_data(data, all_parts):         
-            filtered = [
-                [row[31], get_type(row[31], all_parts), row[14], row[13]]
-                for row in data if validate(row, all_parts)
-            ]
-            
-            return filtered
-
         def get_data():
             """
-            Opens a menu to select the openPO report text file.  
-            The file is then copied and the contents returned as a 
-            list of rows.
+            Opens a menu to select the openPO report text file.
+            The file is then copied and its path returned.
             """
             file = filedialog.askopenfilename(
                 title="Location of openPO",
                 initialdir=r"%USER%\Desktop",
                 filetypes=[("Plain Text", "*.txt"), ("CSV", "*.csv"),],
-            )            
-            
+            )
+
             if file:
-                copied = copy_file(file)
-            
-            data = []
-            with open(file, "r") as csvfile:
-                reader = csvreader(csvfile, delimiter="\t")
-                for row in reader:
-                    data.append(row)
-            
-            return data
- 
+                copy_file(file)
+
+            return file
+
         def show_done():
             """
             Popup window informing the user that autohunt has finished.
@@ -192,31 +271,32 @@ class Main(tk.Tk):
             B1.pack()
             popup.mainloop()
  
-        def hunter_task(popup, data):
+        def hunter_task(popup, file):
             """
-            Pulls the desired orders from the open orders report and
-            displays an indeterminate progress bar to let the user know
-            that the application is not frozen.  Once done the progress
-            bar window is destroyed, purge_subbed is called and the
-            data is saved to and Excel file.
+            Streams the desired orders from the open orders report
+            through hunt and displays an indeterminate progress bar to
+            let the user know that the application is not frozen.  The
+            results are saved to an Excel file as they come in, then
+            the progress bar window is destroyed.
 
             :param popup: Window to display the prograss bar in
+            :param file: Path of the openPO report
             """
             tk.Label(popup, text="Working...\n").grid(row=0, column=0)
             progress_bar = ttk.Progressbar(popup, mode="indeterminate")
             progress_bar.grid(row=1, column=0)
             progress_bar.start(50)
             popup.pack_slaves()
-            all_parts = get_all_parts()           
-            filtered = filter_data(data[1:], all_parts)           
 
-            save_to_file(purge_subbed(filtered))
+            save_to_file(hunt(file, get_all_parts()))
             popup.destroy()
             show_done()
 
-        data = get_data()
+        file = get_data()
+        if not file:
+            return
         popup = tk.Toplevel()
-        t = Thread(target=hunter_task, args=(popup,data))
+        t = Thread(target=hunter_task, args=(popup, file))
         t.start()
 
 
@@ -684,8 +764,8 @@ class EditPartPage(tk.Frame):
         """
         clear_widgets(self.sub_frame)
         self.table = self.info_type_var.get().lower()
-        if part_num != "" and part_in_db(self.table, part_num):
-            self.part_info = convert_to_dict(self.table, part_num)
+        self.part_info = convert_to_dict(self.table, part_num) if part_num != "" else None
+        if self.part_info is not None:
             for row_num, key in enumerate(self.part_info):
                 if key in ["do_not_sub", "subbed"]:
                     self.part_info[key] = str(self.part_info[key]).upper()
@@ -754,7 +834,7 @@ class EditPartPage(tk.Frame):
                 )
         elif part_num == "":
             messagebox.showerror("Invalid Entry", "Please enter a part number.")
-        elif not part_in_db(self.table, part_num):
+        else:
             messagebox.showerror(
                 "Invalid Entry", part_num + " does not exist in the database."
             )
@@ -798,6 +878,62 @@ class SearchPage(tk.Frame):
             command=lambda: self.show_part_info(self.info_search_box.get().strip()),
         )
         self.info_search_button.grid(column=3, row=0, sticky="EW")
+        SuggestionBox(
+            self.info_search_box, lambda: [self.info_type_var.get().lower()]
+        )
+
+        self.text_search_label = tk.Label(self.container, text="Search Descriptions: ")
+        self.text_search_label.grid(column=0, row=1, sticky="EW")
+
+        self.text_search_box = tk.Entry(self.container, text="")
+        self.text_search_box.grid(column=1, row=1, sticky="EW")
+
+        self.text_search_button = tk.Button(
+            self.container,
+            text="Find",
+            command=lambda: self.show_matches(self.text_search_box.get().strip()),
+        )
+        self.text_search_button.grid(column=3, row=1, sticky="EW")
+
+    def show_matches(self, text):
+        """
+        Lists the parts whose brand, description or OEM part number
+        match text, best match first.  Double clicking one shows its
+        details.
+
+        :param text: Words to search for
+        """
+        clear_widgets(self.sub_frame)
+        if text == "":
+            messagebox.showerror("Invalid Entry", "Please enter something to search for.")
+            return
+        self.matches = search_parts(text, [table.lower() for table in self.info_types])
+        if not self.matches:
+            messagebox.showinfo("No Matches", "No parts match " + text + ".")
+            return
+
+        headers = ("Type", "Part Number", "Brand", "Description")
+        self.matches_tv = Treeview(
+            self.sub_frame,
+            columns=list(range(len(headers))),
+            show="headings",
+            height=min(len(self.matches), 20),
+        )
+        for col, header in enumerate(headers):
+            self.matches_tv.heading(col, text=header)
+        self.matches_tv.column(3, width=400)
+        for row, match in enumerate(self.matches):
+            self.matches_tv.insert(
+                "", tk.END, iid=str(row), values=(match[0].upper(),) + tuple(match[1:])
+            )
+        self.matches_tv.grid(column=0, row=0, sticky="EW")
+        self.matches_tv.bind("<Double-1>", self.open_match)
+
+    def open_match(self, event):
+        item = self.matches_tv.selection()[0]
+        table, part_num = self.matches[int(item)][:2]
+        self.info_type_var.set(table.upper())
+        self.show_part_info(part_num)
 
     def show_part_info(self, part_num):
         """
@@ -808,8 +944,8 @@ class SearchPage(tk.Frame):
         """
         clear_widgets(self.sub_frame)
         self.table = self.info_type_var.get().lower()
-        if part_num != "" and part_in_db(self.table, part_num):
-            self.part_dict = convert_to_dict(self.table, part_num)
+        self.part_dict = convert_to_dict(self.table, part_num) if part_num != "" else None
+        if self.part_dict is not None:
             self.part_info = {
                 key: value for key, value in self.part_dict.items() if value != ""
             }
@@ -824,9 +960,9 @@ class SearchPage(tk.Frame):
                 )
         elif part_num == "":
             messagebox.showerror("Invalid Entry", "Please enter a part number.")
-        elif not part_in_db(self.table, part_num):
+        else:
             messagebox.showerror(
-                "Invalid Entry", part_num + " does not exist in the database."
+                "Invalid Entry", not_found_message(self.table, part_num)
             )
 
 
@@ -872,6 +1008,8 @@ class VerifySubsPage(tk.Frame):
             ),
         )
         self.subs_search_button.grid(column=1, row=2)
+        SuggestionBox(self.part_num_box, lambda: [self.subs_type_var.get().lower()])
+        SuggestionBox(self.other_part_box, lambda: [self.subs_type_var.get().lower()])
 
     def show_result(self, result):
         """
@@ -944,6 +1082,9 @@ class FindSubsPage(tk.Frame):
             command=lambda: self.find_subs(self.subs_search_box.get().strip()),
         )
         self.subs_search_button.grid(column=3, row=0)
+        SuggestionBox(
+            self.subs_search_box, lambda: [self.subs_type_var.get().lower()]
+        )
 
     def make_table(self, table, subs):
         """
@@ -982,48 +1123,54 @@ class FindSubsPage(tk.Frame):
         elif table == "cpu":
             headers = ["Brand", "Part Number", "OEM", "Description", "Subbed?"]
 
-        self.widths = {}
-        for col_num in enumerate(subs[0]):
-            columns = []
-            for sub in subs:
-                columns.append(sub[col_num[0]])
-                self.widths[col_num[0]] = max(len(element) for element in columns)
-            self.label_width = max(self.widths[col_num[0]], len(headers[col_num[0]]))
-            if self.widths[col_num[0]] < self.label_width:
-                self.widths[col_num[0]] = self.label_width + 2
+        widths = [len(header) for header in headers]
+        for sub in subs:
+            for col, info in enumerate(sub):
+                widths[col] = max(widths[col], len(str(info)))
 
+        self.results_tv = Treeview(
+            self.results,
+            columns=list(range(len(headers))),
+            show="headings",
+            height=min(len(subs), 20),
+        )
         for col, header in enumerate(headers):
-            tk.Label(
-                self.results, text=header, width=self.widths[col], justify="center"
-            ).grid(column=col, row=0)
+            self.results_tv.heading(col, text=header)
+            self.results_tv.column(col, width=(widths[col] + 2) * 8, anchor="center")
 
-        for row, sub in enumerate(subs):
-            if row % 2 == 0:
-                bg_color = "snow3"
-            else:
-                bg_color = "snow2"
+        self.results_tv.tag_configure("even", background="snow3")
+        self.results_tv.tag_configure("odd", background="snow2")
+        self.results_tv.tag_configure("subbed", foreground="green4")
+        self.results_tv.tag_configure("unsubbed", foreground="Red2")
+        self.results_tv.tag_configure("cvo", foreground="steelblue")
 
-            if sub[-1] == "TRUE":
-                fg_color = "green4"
+        for row, sub in enumerate(subs):
+            if sub[0] == "CVO":
+                status = "cvo"
+            elif sub[-1] == "TRUE":
+                status = "subbed"
             else:
-                fg_color = "Red2"
+                status = "unsubbed"
+            self.results_tv.insert(
+                "",
+                tk.END,
+                iid=str(row),
+                values=sub,
+                tags=("even" if row % 2 == 0 else "odd", status),
+            )
 
-            if sub[0] == "CVO":
-                fg_color = "steelblue"
+        vsb = Scrollbar(self.results, orient="vertical", command=self.results_tv.yview)
+        self.results_tv.configure(yscrollcommand=vsb.set)
+        self.results_tv.grid(column=0, row=0, sticky="NSEW")
+        vsb.grid(column=1, row=0, sticky="NS")
+        self.results.columnconfigure(0, weight=1)
+        self.subs = subs
+        self.results_tv.bind("<Double-1>", self.OnDoubleClick)
 
-            for col, info in enumerate(sub):
-                info_var = tk.StringVar()
-                info_var.set(info)
-                tk.Entry(
-                    self.results,
-                    width=self.widths[col] + 2,
-                    textvariable=info_var,
-                    readonlybackground=bg_color,
-                    foreground=fg_color,
-                    relief="flat",
-                    justify="center",
-                    state="readonly",
-                ).grid(column=col, row=row + 1, sticky="EW")
+    def OnDoubleClick(self, event):
+        item = self.results_tv.selection()[0]
+        self.clipboard_clear()
+        self.clipboard_append(self.subs[int(item)][1])
 
     def find_subs(self, part_num):
         """
@@ -1039,7 +1186,7 @@ class FindSubsPage(tk.Frame):
                 self.make_table(self.table, subs)
         elif not part_in_db(self.table, part_num):
             messagebox.showerror(
-                "Invalid Entry", part_num + " does not exist in the database."
+                "Invalid Entry", not_found_message(self.table, part_num)
             )
 
 
@@ -1096,8 +1243,54 @@ class BrowsePage(tk.Frame):
 
         self.results_tv.column("#" + str(len(self.headers)), minwidth=0, width=0, stretch=False)
 
+        self.add_rows(parts)
+
+    def add_rows(self, parts):
+        """
+        Appends a page of parts to the treeview and remembers where
+        the next page starts.
+
+        :param parts: List of parts
+        """
         for part in parts:
             self.results_tv.insert("", tk.END, text=part[0], values=part[1:])
+        if parts:
+            self.last_part = parts[-1][0]
+        self.exhausted = len(parts) < PAGE_SIZE
+
+    def load_more(self):
+        """
+        Fetches the page after the last loaded part.
+        """
+        self.loading = False
+        if self.exhausted:
+            return
+        self.add_rows(
+            return_page(self.table_var.get(), self.last_part, PAGE_SIZE, self.filters)
+        )
+
+    def on_scroll(self, first, last):
+        """
+        Keeps the scrollbar in step with the treeview and loads the
+        next page once the view nears the bottom of what is loaded.
+        """
+        self.vsb.set(first, last)
+        if float(last) > 0.9 and not self.exhausted and not self.loading:
+            self.loading = True
+            self.after_idle(self.load_more)
+
+    def reset_results(self):
+        """
+        Clears the treeview and shows the first page for the current
+        table and filters.
+        """
+        table = self.table_var.get()
+        self.last_part = None
+        self.exhausted = False
+        self.loading = False
+        self.result_count.set(str(count_rows(table, self.filters)))
+        self.results_tv.delete(*self.results_tv.get_children())
+        self.add_rows(return_page(table, None, PAGE_SIZE, self.filters))
 
     def OnDoubleClick(self, event):
         item = self.results_tv.selection()[0]
@@ -1109,65 +1302,79 @@ class BrowsePage(tk.Frame):
         self.results_tv.pack(expand=True, fill="both")
         self.result_label = tk.Label(self.results_frame, textvariable=self.result_count)
         self.result_label.pack(side="bottom")
-        vsb = Scrollbar(
+        self.vsb = Scrollbar(
             self.results_tv, orient="vertical", command=self.results_tv.yview
         )
-        vsb.place(x=1, y=25, height=400)
+        self.vsb.place(x=1, y=25, height=400)
+        self.results_tv.configure(yscrollcommand=self.on_scroll)
         self.results_tv.bind("<Double-1>", self.OnDoubleClick)
 
     def make_buttons(self, table):
         """
-        Make buttons for filtering data
+        Make buttons for filtering data.  Part numbers, descriptions
+        and other columns with a value per part get no dropdown.
 
         :param table:  Table in sqlite3 db
         """
         self.var_dict = {}
-        columns = return_column_names(table)
-        for column_name in enumerate(columns):
+        self.menu_dict = {}
+        for column_name in enumerate(facet_columns(table)):
             self.var_dict[column_name[1]] = tk.StringVar()
             self.var_dict[column_name[1]].set(column_name[1])
             _ = tk.OptionMenu(
                 self.filter_frame,
                 self.var_dict[column_name[1]],
-                *return_possible_values(table, column_name[1])
+                column_name[1]
             )
             _.configure(width=len(column_name[1]))
+            self.menu_dict[column_name[1]] = _["menu"]
             _.grid(column=column_name[0], row=0, sticky="EW")
             self.var_dict[column_name[1]].trace("w", self.handle_filter_change)
+        self.update_facets()
         tk.Button(self.type_frame, text="Export", command=self.save_to_file).grid(
             column=2, row=0
         )
 
+    def update_facets(self):
+        """
+        Refills every filter dropdown with the values that still
+        match rows under the current filters, each followed by how
+        many rows picking it would show.
+        """
+        counts = facet_counts(
+            self.table_var.get(), self.filters, list(self.var_dict)
+        )
+        for column, menu in self.menu_dict.items():
+            menu.delete(0, tk.END)
+            for value, count in counts[column].items():
+                menu.add_command(
+                    label=str(value) + " (" + str(count) + ")",
+                    command=tk._setit(self.var_dict[column], value),
+                )
+
     def save_to_file(self):
         rows = [self.headers]
-        for child in self.results_tv.get_children():
-            _templst = self.results_tv.item(child)["values"]
-            _templst.insert(0, self.results_tv.item(child)["text"])
-            rows.append(_templst)
+        rows.extend(iter_pages(self.table_var.get(), my_dict=self.filters))
         csv_writer("exported_list.csv", rows)
 
     def handle_filter_change(self, *args):
-        multi_filter = {}
+        self.filters = {}
         for k, v in self.var_dict.items():
             if k != v.get():
-                multi_filter[k] = v.get()
-        parts = filter_columns(self.table_var.get(), multi_filter)
-        self.results_tv.delete(*self.results_tv.get_children())
-        for part in parts:
-            self.results_tv.insert("", tk.END, text=part[0], values=part[1:])
-
-        self.result_count.set(str(len(parts)))
+                self.filters[k] = v.get()
+        self.reset_results()
+        self.update_facets()
 
         tk.Button(
             self.type_frame, text="Clear Filters", command=self.handle_reset
         ).grid(column=1, row=0)
 
     def handle_table_change(self, *args):
-        parts = return_table(self.table_var.get())
-        self.result_count.set(str(len(parts)))
+        self.filters = {}
         self.build_treeview()
-        self.fill_table(parts)
-        self.make_buttons(self.table_var.get())
+        self.fill_table([])
+        self.reset_results()
+        self.make_buttons(self.table_var.get().lower())
 
     def handle_reset(self):
         clear_widgets(self.filter_frame)
@@ -1,4 +1,16 @@
+import io
+import random
+import tempfile
+from contextlib import redirect_stderr, redirect_stdout
+from os import listdir, mkdir, utime
+from os.path import join as pathjoin
+from shutil import rmtree
+
+from openpyxl import load_workbook
+
 from backend import *
+from auto_hunt import (get_part_type_index, hunt_path, iter_purged, main,
+                       purge_subbed, save_to_file)
 
 
 def import_test():
@@ -13,6 +25,8 @@ def import_test():
         assert part_in_db("hdd_test", "1111112") == True
         assert part_in_db("hdd_test", "2222222") == True
         assert part_in_db("hdd_test", "2222223") == True
+        assert part_sub_group("hdd_test", "1111111") != None
+        assert ("hdd_test", "1111111") in prefix_parts("111111", ["hdd_test"])
         print("Import: Passed!\n")
     except AssertionError as e:
         print("Import: Failed!\n")
@@ -97,6 +111,21 @@ def valid_sub_test():
         print(repr(e))        
         
 
+def list_subs_many_test():
+    """Test listing subs for many parts at once"""
+    subs = list_subs_many("hdd_test", ["111", "222", "000"])
+    valid = is_valid_sub_many("hdd_test", [("111", "112"), ("111", "222"), ("000", "111")])
+    try:
+        assert subs["111"] == list_subs("hdd_test", "111")
+        assert subs["222"] == list_subs("hdd_test", "222")
+        assert subs["000"] == []
+        assert valid == [True, False, False]
+        print("List subs many: Passed!\n")
+    except AssertionError as e:
+        print("List subs many: Failed!\n")
+        print(repr(e))
+
+
 def edit_part_test():
     """Test checking if parts are updated correctly"""
     part_num = ["TEST", "999", "999", "999", "999", "999", "999", "999", "999", "999", "999", "TRUE", "TRUE"]
@@ -113,10 +142,408 @@ def edit_part_test():
         print(repr(e))
     
     
+def sub_status_test():
+    """Test looking up sub flags for many parts at once"""
+    status = part_sub_status([("1111111", "hdd_test"), ("2222222", "hdd_test"),
+                              ("0000000", "hdd_test"), ("123", "mem_test")])
+    try:
+        assert status[("1111111", "hdd_test")] == ("TRUE", "FALSE")
+        assert status[("2222222", "hdd_test")] == ("FALSE", "FALSE")
+        assert status[("0000000", "hdd_test")] is None
+        assert status[("123", "mem_test")] == ("TRUE", "FALSE")
+        print("Sub status: Passed!\n")
+    except AssertionError as e:
+        print("Sub status: Failed!\n")
+        print(repr(e))
+
+
+def parallel_purge_test():
+    """Test the hunt check gives the same parts in the same order in worker processes"""
+    rng = random.Random(13)
+    parts = [(row[0], "HDD_TEST") for row in return_table("hdd_test")]
+    parts += [(row[0], "MEM_TEST") for row in return_table("mem_test")]
+    parts += [("X" + str(n), "MEM_TEST") for n in range(5)]
+    parts += [("Y" + str(n), "NO_TABLE") for n in range(5)]
+    lines = []
+    for so_num in range(3600):
+        part_num, part_type = rng.choice(parts)
+        warranty = rng.choice(["MFG Warranty", "Non-Warranty"])
+        lines.append([part_num, part_type, warranty, str(so_num)])
+    serial = purge_subbed(lines)
+    parallel = purge_subbed(lines, processes=3)
+    batched = list(iter_purged(lines, 1000, processes=3))
+    try:
+        assert 0 < len(serial) < len(lines)
+        assert parallel == serial
+        assert batched == serial
+        missing = [line for line in lines if line[0][0] in "XY"]
+        assert [line for line in serial if line[0][0] in "XY"] == missing
+        print("Parallel purge: Passed!\n")
+    except AssertionError as e:
+        print("Parallel purge: Failed!\n")
+        print(repr(e))
+
+
+def write_hunt_files(folder, part_nums):
+    """Writes a parts_in_sp folder listing part_nums as HDDs and an openPO report ordering them"""
+    parts = pathjoin(folder, "parts_in_sp")
+    mkdir(parts)
+    for part_type in ("HDD", "MEM", "CPU"):
+        with open(pathjoin(parts, "all" + part_type + ".csv"), "w") as f:
+            if part_type == "HDD":
+                f.write("\n".join(part_nums) + "\n")
+    report = pathjoin(folder, "openPO.txt")
+    with open(report, "w") as f:
+        f.write("\t".join("col" + str(n) for n in range(32)) + "\n")
+        for so_num, part_num in enumerate(part_nums):
+            row = [""] * 32
+            row[0], row[13], row[21], row[31] = "1320", str(so_num), "ACE", part_num
+            row[14] = row[15] = "MFG Warranty" if so_num % 2 else "Non-Warranty"
+            f.write("\t".join(row) + "\n")
+    return parts, report
+
+
+def part_type_index_test():
+    """Test part type precedence, blank lines and when the index is rebuilt"""
+    folder = tempfile.mkdtemp()
+    files = {"HDD": "H1\nHM\n\nHMC\n",
+             "MEM": "M1\nHM\nMC\n\nHMC\n",
+             "CPU": "\nC1\nMC\nHMC\n"}
+    for part_type, lines in files.items():
+        with open(pathjoin(folder, "all" + part_type + ".csv"), "w") as f:
+            f.write(lines)
+    index = get_part_type_index(folder)
+    same = get_part_type_index(folder)
+    mem_file = pathjoin(folder, "allMEM.csv")
+    with open(mem_file, "a") as f:
+        f.write("M2\n")
+    utime(mem_file, (0, 0))
+    rebuilt = get_part_type_index(folder)
+    rmtree(folder)
+    try:
+        assert same is index
+        assert rebuilt is not index
+        assert rebuilt.get("M2") == "MEM" and index.get("M2") == None
+        assert [index.get(p) for p in ("H1", "M1", "C1")] == ["HDD", "MEM", "CPU"]
+        assert index.get("HM") == "HDD" and index.get("HMC") == "HDD"
+        assert index.get("MC") == "MEM"
+        assert len(index) == 6 and "" not in index
+        assert "" not in index["CPU"] and len(index["MEM"]) == 4
+        print("Part type index: Passed!\n")
+    except AssertionError as e:
+        print("Part type index: Failed!\n")
+        print(repr(e))
+
+
+def main_test():
+    """Test the command line hunt and its exit status"""
+    folder = tempfile.mkdtemp()
+    out = pathjoin(folder, "hunts")
+    mkdir(out)
+    parts, report = write_hunt_files(folder, ["NOPART1", "NOPART2"])
+    common = ["--out", out, "--parts", parts, "--processes", "0"]
+    output = io.StringIO()
+    with redirect_stdout(output), redirect_stderr(output):
+        no_db = main(["--report", report, "--db", pathjoin(folder, "none.db")] + common)
+        no_report = main(["--report", pathjoin(folder, "none.txt"),
+                          "--db", connections.database] + common)
+        files_after_errors = sorted(listdir(folder)), listdir(out)
+        ran = main(["--report", report, "--db", connections.database] + common)
+    try:
+        assert no_db == 1 and no_report == 1
+        assert files_after_errors == (["hunts", "openPO.txt", "parts_in_sp"], [])
+        assert "Exception ignored" not in output.getvalue()
+        assert ran == 0
+        workbook = load_workbook(hunt_path(out))
+        needs_sub = [list(row) for row in workbook["Needs Sub"].values]
+        assert needs_sub == [["Part Num", "Type"], ["NOPART1", "HDD"], ["NOPART2", "HDD"]]
+        print("Main: Passed!\n")
+    except AssertionError as e:
+        print("Main: Failed!\n")
+        print(repr(e))
+    finally:
+        rmtree(folder)
+
+
+def save_to_file_test():
+    """Test both sheets of a saved hunt, with and without non-warranty orders"""
+    folder = tempfile.mkdtemp()
+    mixed = [["A1", "HDD", "MFG Warranty", "1"],
+             ["B2", "MEM", "Non-Warranty", "2"],
+             ["A1", "HDD", "Non-Warranty", "3"]]
+    warranty = [["C3", "CPU", "MFG Warranty", "4"],
+                ["C3", "CPU", "MFG Warranty", "5"]]
+    mkdir(pathjoin(folder, "mixed"))
+    mkdir(pathjoin(folder, "warranty"))
+    save_to_file(iter(mixed), pathjoin(folder, "mixed"))
+    save_to_file(iter(warranty), pathjoin(folder, "warranty"))
+    mixed_book = load_workbook(hunt_path(pathjoin(folder, "mixed")))
+    warranty_book = load_workbook(hunt_path(pathjoin(folder, "warranty")))
+    rmtree(folder)
+    try:
+        assert mixed_book.sheetnames == ["Needs Sub", "Non-Warr Orders"]
+        assert [list(row) for row in mixed_book["Needs Sub"].values] == [
+            ["Part Num", "Type"], ["A1", "HDD"], ["B2", "MEM"]]
+        assert [list(row) for row in mixed_book["Non-Warr Orders"].values] == [
+            ["Part Num", "Type", "Warr", "SO"], mixed[1], mixed[2]]
+        assert [list(row) for row in warranty_book["Needs Sub"].values] == [
+            ["Part Num", "Type"], ["C3", "CPU"]]
+        assert list(warranty_book["Non-Warr Orders"].values) == []
+        print("Save to file: Passed!\n")
+    except AssertionError as e:
+        print("Save to file: Failed!\n")
+        print(repr(e))
+
+
+def facets_test():
+    """Test distinct column values and that writes refresh them"""
+    part = ["999","Facet","SATA","500","","7200","HDD","2.5","7","SATA III","","FALSE","TRUE"]
+    before = return_facets("hdd_test", ["brand", "type"])
+    return_facets("HDD_TEST", ["brand"])
+    opened = facet_counts("HDD_TEST")
+    reopened = facet_counts("hdd_test")
+    add_part("hdd_test", part)
+    refreshed = facet_counts("HDD_TEST")
+    after = return_possible_values("hdd_test", "brand")
+    upper_after = return_facets("HDD_TEST", ["brand"])["brand"]
+    counts = facet_counts("hdd_test", {"brand": "Facet"}, ["brand", "speed"])
+    every = facet_counts("hdd_test", {"brand": "Facet"})
+    remove_part("hdd_test", "999")
+    try:
+        assert "Acer" in before["brand"] and "Facet" not in before["brand"]
+        assert before["type"] == sorted(set(before["type"]))
+        assert "" not in before["type"]
+        assert "Facet" in after
+        assert "Facet" in upper_after
+        assert reopened["brand"] is opened["brand"]
+        assert "Facet" not in opened["brand"]
+        assert refreshed["brand"]["Facet"] == 1
+        assert "Facet" not in return_facets("HDD_TEST", ["brand"])["brand"]
+        assert counts["speed"] == {"7200": 1}
+        assert sorted(every) == sorted(facet_columns("hdd_test"))
+        assert "part_num" not in every and "description" not in every
+        assert counts["brand"]["Facet"] == 1 and "Acer" in counts["brand"]
+        assert "Facet" not in return_possible_values("hdd_test", "brand")
+        print("Facets: Passed!\n")
+    except AssertionError as e:
+        print("Facets: Failed!\n")
+        print(repr(e))
+
+
+def filter_test():
+    """Test filtering on several columns, including quoted values"""
+    parts = filter_columns("hdd_test", {"type": "SSHD", "brand": "Acer"})
+    same = filter_columns("hdd_test", {"brand": "Acer", "type": "SSHD"})
+    cached = table_indexes("HDD_TEST")
+    analyze_tables(["hdd_test"])
+    analyzed = table_indexes("HDD_TEST")
+    try:
+        assert any(part[0] == "112" for part in parts) == True
+        assert all(part[1] == "Acer" and part[6] == "SSHD" for part in parts)
+        assert sorted(parts) == sorted(same)
+        assert count_rows("hdd_test", {"type": "SSHD", "brand": "Acer"}) == len(parts)
+        assert filter_columns("hdd_test", {"brand": "O'Brien"}) == []
+        assert analyzed is not cached and analyzed is table_indexes("hdd_test")
+        assert analyzed["hdd_test_brand"][1] != None
+        assert choose_index("HDD_TEST", {"brand": "Acer"}) == choose_index("hdd_test", {"brand": "Acer"})
+        print("Filter: Passed!\n")
+    except AssertionError as e:
+        print("Filter: Failed!\n")
+        print(repr(e))
+
+
+def pagination_test():
+    """Test paging through a table in part_num order, with and without a filter"""
+    pages = []
+    page = return_page("hdd_test", None, 2)
+    while page:
+        pages.append(page)
+        page = return_page("hdd_test", page[-1][0], 2)
+    rows = [row for page in pages for row in page]
+    hdds = list(iter_pages("hdd_test", 2, {"type": "HDD"}))
+    hdds_by_one = list(iter_pages("hdd_test", 1, {"type": "HDD"}))
+    try:
+        assert len(pages) > 2 and all(len(page) <= 2 for page in pages)
+        assert rows == sorted(return_table("hdd_test"))
+        assert len(set(row[0] for row in rows)) == len(rows)
+        assert list(iter_pages("hdd_test", 2)) == rows
+        assert len(hdds) > 2
+        assert hdds == sorted(filter_columns("hdd_test", {"type": "HDD"}))
+        assert hdds_by_one == hdds
+        assert len(hdds) == count_rows("hdd_test", {"type": "HDD"})
+        print("Pagination: Passed!\n")
+    except AssertionError as e:
+        print("Pagination: Failed!\n")
+        print(repr(e))
+
+
+def record_cache_test():
+    """Test repeat lookups are cached and writes invalidate them"""
+    part = ["998","Cache","SATA","500","","7200","HDD","2.5","7","SATA III","","FALSE","TRUE"]
+    add_part("hdd_test", part)
+    search_part("hdd_test", "998")
+    hits = record_cache.stats()["hits"]
+    first = search_part("hdd_test", "998")
+    part[1] = "Cached"
+    update_part("hdd_test", part)
+    updated = convert_to_dict("hdd_test", "998")
+    remove_part("HDD_TEST", "998")
+    try:
+        assert first[1] == "Cache"
+        assert record_cache.stats()["hits"] > hits
+        assert updated["brand"] == "Cached"
+        assert part_in_db("hdd_test", "998") == False
+        assert convert_to_dict("hdd_test", "998") == None
+        print("Record cache: Passed!\n")
+    except AssertionError as e:
+        print("Record cache: Failed!\n")
+        print(repr(e))
+
+
+def sub_groups_test():
+    """Test sub groups follow inserts, updates and deletes"""
+    alone = ["997","Acer","IDE","12345","","4200","HDD","3.5","25","ATA","","FALSE","TRUE"]
+    partner = ["996","Acer","IDE","12345","","4200","HDD","3.5","25","ATA","","FALSE","TRUE"]
+    add_part("hdd_test", alone)
+    was_alone = "997" in parts_without_subs("hdd_test")
+    add_part("hdd_test", partner)
+    paired = part_sub_group("hdd_test", "997")
+    was_paired = "997" not in parts_without_subs("hdd_test")
+    partner[3] = "54321"
+    update_part("hdd_test", partner)
+    split = part_sub_group("hdd_test", "997")
+    remove_part("hdd_test", "997")
+    remove_part("hdd_test", "996")
+    try:
+        assert was_alone == True
+        assert was_paired == True
+        assert paired["member_count"] == 2
+        assert split["member_count"] == 1
+        assert "997" not in parts_without_subs("hdd_test")
+        assert part_sub_group("hdd_test", "997") == None
+        print("Sub groups: Passed!\n")
+    except AssertionError as e:
+        print("Sub groups: Failed!\n")
+        print(repr(e))
+
+
+def search_test():
+    """Test free-text search follows added, edited and removed parts"""
+    part = ["995","2400","Acer","SO-DIMM","8GB","8GB DDR4 2400 SoDIMM","FALSE","TRUE"]
+    add_part("mem_test", part)
+    found = search_parts("ddr4 sodimm", ["mem_test"])
+    part[5] = "16GB DDR4 3200 SoDIMM"
+    update_part("mem_test", part)
+    updated = search_parts("3200", ["mem_test"])
+    remove_part("mem_test", "995")
+    try:
+        assert ("mem_test", "995") in [result[:2] for result in found]
+        assert ("mem_test", "995") in [result[:2] for result in updated]
+        assert ("mem_test", "995") not in [result[:2] for result in search_parts("3200")]
+        assert search_parts("") == []
+        print("Search: Passed!\n")
+    except AssertionError as e:
+        print("Search: Failed!\n")
+        print(repr(e))
+
+
+def suggest_test():
+    """Test part number lookup by prefix and with typos"""
+    part = ["ABC12345","Acer","SATA","500","","7200","HDD","2.5","7","SATA III","","FALSE","TRUE"]
+    add_part("hdd_test", part)
+    by_prefix = prefix_parts("abc1", ["hdd_test"])
+    by_typo = similar_parts("ABC12354", ["hdd_test"])
+    suggested = suggest_parts("ABX12345", ["hdd_test"])
+    remove_part("hdd_test", "ABC12345")
+    try:
+        assert ("hdd_test", "ABC12345") in by_prefix
+        assert ("hdd_test", "ABC12345", 2) in by_typo
+        assert ("hdd_test", "ABC12345") in suggested
+        assert similar_parts("ABC12354", ["hdd_test"]) == []
+        assert edit_distance("kitten", "sitting", 5) == 3
+        print("Suggest: Passed!\n")
+    except AssertionError as e:
+        print("Suggest: Failed!\n")
+        print(repr(e))
+
+
+def restore_triggers_test():
+    """Test triggers left dropped by a killed import are put back on opening"""
+    part = ["R1","PC4-19200S","Acer","SO-DIMM","4GB","4GB DDR4","FALSE","TRUE"]
+    partner = ["R2","PC4-19200S","Acer","SO-DIMM","4GB","4GB DDR4","FALSE","TRUE"]
+    with connections.transaction():
+        drop_part_triggers("mem_test")
+        insert_rows("mem_test", SCHEMAS["mem"], [part])
+    connections.close()
+    connections.upgraded = False
+    connections.connection()
+    add_part("mem_test", partner)
+    group = part_sub_group("mem_test", "R2")
+    found = prefix_parts("R", ["mem_test"])
+    remove_part("mem_test", "R1")
+    remove_part("mem_test", "R2")
+    try:
+        assert group != None and group["member_count"] == 2
+        assert ("mem_test", "R1") in found and ("mem_test", "R2") in found
+        assert part_sub_group("mem_test", "R1") == None
+        print("Restore triggers: Passed!\n")
+    except AssertionError as e:
+        print("Restore triggers: Failed!\n")
+        print(repr(e))
+
+
+def import_directory_test():
+    """Test importing a folder of CSV files, some of them bad"""
+    folder = tempfile.mkdtemp()
+    files = {
+        "cpu_dir.csv": "part_num,brand,description,oem_part_num,do_not_sub,subbed\n"
+                       "D1,GPC,Intel I5-8250U,SR3LA,FALSE,TRUE\n\n"
+                       "D2,Dell,Intel I5-8250U,SR3LA,FALSE,FALSE\n"
+                       "D1,HP,Intel I5-8250U,SR3LA,FALSE,FALSE\n",
+        "mem_dir.csv": "part_num,speed,brand,connector,capacity,description,do_not_sub,subbed\n"
+                       "D3,PC4-19200S,CVO,SO-DIMM,8GB,8GB DDR4,FALSE,TRUE\n"
+                       "D4,PC4-19200S,Lenovo,SO-DIMM,8GB,8GB DDR4,FALSE,FALSE\n"
+                       "D5,PC4-19200S,Lenovo,DIMM,8GB\n",
+        "mem_bad.csv": "part_num,speed,speed\nD6,PC4-19200S,PC4-19200S\n",
+    }
+    for name, text in files.items():
+        with open(pathjoin(folder, name), "w") as csvfile:
+            csvfile.write(text)
+    mkdir(pathjoin(folder, "cpu_dir2.csv"))
+    summary = import_directory(folder, processes=2, chunk_size=2)
+    by_table = {stats["table"]: stats for stats in summary}
+    cpu_rows = sorted(return_table("cpu_dir"))
+    mem_rows = sorted(return_table("mem_dir"))
+    subs = list_subs("mem_dir", "D4")
+    remove_table("cpu_dir")
+    remove_table("mem_dir")
+    rmtree(folder)
+    try:
+        assert sorted(by_table) == ["cpu_dir", "cpu_dir2", "mem_bad", "mem_dir"]
+        assert (by_table["cpu_dir"]["rows"], by_table["cpu_dir"]["inserted"],
+                by_table["cpu_dir"]["ignored"]) == (3, 2, 1)
+        assert by_table["cpu_dir"]["error"] == None
+        assert (by_table["mem_dir"]["rows"], by_table["mem_dir"]["inserted"]) == (3, 3)
+        assert by_table["mem_bad"]["error"] != None
+        assert by_table["mem_bad"]["inserted"] == 0
+        assert by_table["cpu_dir2"]["error"] != None
+        assert table_exists("mem_bad") == False
+        assert cpu_rows == [("D1","GPC","Intel I5-8250U","SR3LA","FALSE","TRUE"),
+                            ("D2","Dell","Intel I5-8250U","SR3LA","FALSE","FALSE")]
+        assert mem_rows[2] == ("D5","PC4-19200S","Lenovo","DIMM","8GB",None,None,None)
+        assert sorted(sub[1] for sub in subs) == ["D3", "D4"]
+        print("Import directory: Passed!\n")
+    except AssertionError as e:
+        print("Import directory: Failed!\n")
+        print(repr(e))
+
+
 def remove_table_test():
     """Test checking if tables are removed correctly"""
+    return_column_names("HDD_TEST")
     try:
         assert remove_table("hdd_test") == True
+        assert table_schemas.has_table("HDD_TEST") == False
         assert remove_table("mem_test") == True
         assert remove_table("cpu_test") == True
         print("Remove table: Passed!\n")
@@ -125,10 +552,26 @@ def remove_table_test():
         print(repr(e))
      
                 
-import_test()
-add_part_test()
-remove_part_test()    
-list_subs_test()
-valid_sub_test()
-edit_part_test()
-remove_table_test()
+if __name__ == "__main__":
+    import_test()
+    add_part_test()
+    remove_part_test()
+    list_subs_test()
+    valid_sub_test()
+    list_subs_many_test()
+    edit_part_test()
+    sub_status_test()
+    parallel_purge_test()
+    part_type_index_test()
+    main_test()
+    save_to_file_test()
+    facets_test()
+    filter_test()
+    pagination_test()
+    record_cache_test()
+    sub_groups_test()
+    search_test()
+    suggest_test()
+    restore_triggers_test()
+    import_directory_test()
+    remove_table_test()